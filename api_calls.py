@@ -0,0 +1,120 @@
+import json
+import random
+import threading
+import time
+from collections import Counter
+from email.utils import parsedate_to_datetime
+
+import requests
+from googleapiclient.errors import HttpError
+
+from instrumentation import metrics
+from rate_limit import GMAIL_METHOD_UNITS, MESSAGE_GET_UNITS
+
+MAX_RETRIES = 6
+BASE_DELAY = 1.0
+MAX_DELAY = 64.0
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded'}
+TRANSIENT_ERRORS = (ConnectionError, TimeoutError, requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+
+class CallStats:
+    """Process-wide counters of API calls, retries and time spent waiting on quota."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.retries = Counter()
+        self.throttled_seconds = 0.0
+
+    def record_call(self, endpoint):
+        with self.lock:
+            self.calls[endpoint] += 1
+
+    def record_wait(self, seconds, endpoint=None):
+        with self.lock:
+            self.throttled_seconds += seconds
+            if endpoint is not None:
+                self.retries[endpoint] += 1
+
+    def summary(self):
+        return (f"API calls: {sum(self.calls.values())}, retries: {sum(self.retries.values())}, "
+                f"throttled: {self.throttled_seconds:.1f}s")
+
+
+stats = CallStats()
+
+
+def _error_reasons(error):
+    try:
+        details = json.loads(error.content.decode('utf-8'))['error'].get('errors', [])
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return set()
+    return {detail.get('reason') for detail in details}
+
+
+def is_rate_limited(error):
+    if not isinstance(error, HttpError):
+        return False
+    status = error.resp.status
+    return status == 429 or (status == 403 and bool(_error_reasons(error) & RATE_LIMIT_REASONS))
+
+
+def is_transient(error):
+    if isinstance(error, HttpError):
+        return error.resp.status in RETRYABLE_STATUSES or is_rate_limited(error)
+    return isinstance(error, TRANSIENT_ERRORS)
+
+
+def _retry_after(error):
+    value = error.resp.get('retry-after') if isinstance(error, HttpError) else None
+    if not value:
+        return 0.0
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def backoff(error, attempt, limiter=None, endpoint='batch'):
+    """Sleep before retry `attempt`: full-jitter exponential backoff, never shorter than Retry-After."""
+    if limiter is not None and is_rate_limited(error):
+        limiter.throttle()
+    delay = max(random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** attempt)), _retry_after(error))
+    stats.record_wait(delay, endpoint)
+    time.sleep(delay)
+
+
+def quota_cost(endpoint):
+    if endpoint.startswith('gmail.'):
+        return GMAIL_METHOD_UNITS.get(endpoint, MESSAGE_GET_UNITS)
+    return 1
+
+
+def execute(request, limiter=None, cost=None, max_retries=MAX_RETRIES):
+    """Execute a googleapiclient request or batch under `limiter`, retrying transient errors."""
+    endpoint = getattr(request, 'methodId', None) or 'batch'
+    if cost is None:
+        cost = quota_cost(endpoint)
+    attempt = 0
+    while True:
+        if limiter is not None:
+            stats.record_wait(limiter.acquire(cost))
+        stats.record_call(endpoint)
+        try:
+            with metrics.call(endpoint):
+                response = request.execute()
+        except Exception as error:
+            if attempt >= max_retries or not is_transient(error):
+                raise
+            backoff(error, attempt, limiter, endpoint)
+            attempt += 1
+        else:
+            if limiter is not None:
+                limiter.recover()
+            return response
@@ -0,0 +1,167 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from email_parsing import get_message_subject, is_sale_message, parse_sale
+from instrumentation import metrics
+
+# googleapiclient has no async transport, so every blocking call runs in a worker
+# thread on the shared pooled transport. Quota limits and retries are applied per
+# request by api_calls.execute, using the managers' own limiters.
+
+# Sales are written to the sheet in flushes of at most this many rows.
+FLUSH_SIZE = 500
+
+
+class _Pipeline:
+    def __init__(self, gmail_manager, sheets_manager, sale_index, concurrency, pool, email_cache=None,
+                 flush_size=FLUSH_SIZE, sales_store=None):
+        self.gmail_manager = gmail_manager
+        self.sheets_manager = sheets_manager
+        self.sale_index = sale_index
+        self.email_cache = email_cache
+        self.sales_store = sales_store
+        self.pool = pool
+        self.flush_size = flush_size
+        self.flushed = False
+        # Message IDs waiting in the sheet buffer, so a sale is never queued twice before a flush.
+        self.queued_ids = set()
+        # Holding at most `concurrency` fetched-but-unwritten batches gives us back-pressure.
+        self.batches = asyncio.Queue(maxsize=concurrency)
+        # Finished tasks drop out, so nothing here grows with the size of the mailbox.
+        self.tasks = set()
+
+    def start(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def prepare_sheet(self, reconcile_index):
+        # Row counts saved by the last run spare us downloading every sheet's A:E.
+        self.sheets_manager.load_row_counts(self.sale_index.sheet_rows())
+        await asyncio.to_thread(self.sheets_manager.get_next_empty_row, "Sheet1")
+        # An empty index would let every sale already in the sheet through again.
+        if reconcile_index or not len(self.sale_index):
+            await asyncio.to_thread(lambda: self.sale_index.reconcile(self.sheets_manager.read_sales()))
+        if self.sales_store is not None:
+            # Sales stored by a run that failed before writing them to the sheet.
+            self.record(self.sales_store.unsynced())
+
+    async def produce(self, message_ids):
+        batch_size = self.gmail_manager.batch_size
+        while chunk := await asyncio.to_thread(lambda: list(islice(message_ids, batch_size))):
+            await self.batches.put(self.start(self.fetch_and_parse(chunk)))
+        await self.batches.put(None)
+
+    async def fetch_and_parse(self, message_ids):
+        if self.email_cache is None:
+            return await self.fetch_sales(message_ids)
+        # The cache is only touched from the event loop thread, like the sale index.
+        sale_subject = self.gmail_manager.sale_subject
+        cached, _, missing_ids = self.email_cache.lookup(message_ids, sale_subject)
+        metrics.add_items('email_cache_hits', len(message_ids) - len(missing_ids))
+        if missing_ids:
+            sales = await self.fetch_sales(missing_ids)
+            self.email_cache.add_sales(sales, sale_subject)
+            cached.update((sale['message_id'], sale) for sale in sales)
+        return [cached[message_id] for message_id in message_ids if message_id in cached]
+
+    async def fetch_sales(self, message_ids):
+        gmail_manager = self.gmail_manager
+        sale_subject = gmail_manager.sale_subject
+        headers = await asyncio.to_thread(gmail_manager.fetch_messages, message_ids, 'metadata', ['Subject', 'From'])
+        sale_ids = [msg['id'] for msg in headers if is_sale_message(msg, sale_subject, gmail_manager.sale_sender)]
+        if self.email_cache is not None:
+            # Only other subjects are cached as non-sales: the negative entries are keyed on the subject alone.
+            self.email_cache.add_non_sales(msg for msg in headers if get_message_subject(msg) != sale_subject)
+        if not sale_ids:
+            return []
+        messages = await asyncio.to_thread(gmail_manager.fetch_messages, sale_ids)
+        if self.pool is None:
+            return await asyncio.to_thread(lambda: [parse_sale(msg) for msg in messages])
+        loop = asyncio.get_running_loop()
+        # Worker processes keep their own metrics, so time the batch as the parent sees it.
+        with metrics.stage('parse_batch'):
+            sales = await asyncio.gather(*(loop.run_in_executor(self.pool, parse_sale, msg) for msg in messages))
+        metrics.add_items('parse_batch', len(sales))
+        return sales
+
+    async def write(self, sheet_ready):
+        # Batches are consumed in listing order, so dedup and row order match a serial run.
+        await sheet_ready
+        found = False
+        while (batch := await self.batches.get()) is not None:
+            sales = await batch
+            found = found or bool(sales)
+            self.record(sales)
+            if len(self.sheets_manager.pending_items) >= self.flush_size:
+                await self.flush()
+        return found
+
+    def record(self, sales):
+        """Queue the sales that are not in the sheet yet, and keep every sale in the sales store."""
+        with metrics.stage('dedup'):
+            new_sales, recorded = [], []
+            for sale in sales:
+                if sale['message_id'] in self.queued_ids:
+                    continue
+                (recorded if self.sale_index.is_recorded(sale) else new_sales).append(sale)
+            self.sheets_manager.queue_items(new_sales)
+            self.queued_ids.update(sale['message_id'] for sale in new_sales)
+            if self.sales_store is not None:
+                self.sales_store.add(new_sales)
+                self.sales_store.add(recorded, synced=True)
+                self.sales_store.mark_synced(recorded)
+        metrics.add_items('dedup', len(sales))
+
+    async def flush(self):
+        if self.flushed and not self.sheets_manager.pending_items:
+            return
+        appended = await asyncio.to_thread(self.sheets_manager.flush, "Sheet1")
+        # Recorded straight away, so a later failure cannot write these rows twice.
+        self.sale_index.add(appended)
+        self.sale_index.save_sheet_rows(self.sheets_manager.row_state())
+        if self.sales_store is not None:
+            self.sales_store.mark_synced(appended)
+        self.queued_ids.clear()
+        self.flushed = True
+
+    def cancel(self):
+        for task in list(self.tasks):
+            task.cancel()
+
+
+async def run_sync(gmail_manager, sheets_manager, state, sale_index, full_resync=False, reconcile_index=False,
+                   parse_workers=0, concurrency=None, email_cache=None, flush_size=FLUSH_SIZE, sales_store=None):
+    """Sync new sale emails into the sheet with Gmail and Sheets I/O overlapped.
+
+    Up to `concurrency` message batches (default: the manager's max_workers) are in flight
+    at once, rate limited by the managers' Gmail and Sheets quota buckets. If any stage fails, the
+    others are cancelled and the error is raised without moving the checkpoint.
+    Messages already in `email_cache` (an EmailCache) are not fetched again. Sales are
+    written every `flush_size` rows, so memory stays bounded however large the mailbox is.
+    Every sale found is also kept in `sales_store` (a SalesStore), marked synced once it is in the sheet.
+    Returns True if any sale email was found.
+    """
+    # Rows a failed run left queued are queued again from the sales store, so they must not be written twice.
+    sheets_manager.pending_items.clear()
+    pool = ProcessPoolExecutor(max_workers=parse_workers) if parse_workers > 0 else None
+    pipeline = _Pipeline(gmail_manager, sheets_manager, sale_index, concurrency or gmail_manager.max_workers, pool,
+                         email_cache, flush_size, sales_store)
+    try:
+        sheet_ready = pipeline.start(pipeline.prepare_sheet(reconcile_index))
+        history_id, message_ids = await asyncio.to_thread(gmail_manager.changed_message_ids, state, full_resync)
+        producer = pipeline.start(pipeline.produce(message_ids))
+        writer = pipeline.start(pipeline.write(sheet_ready))
+        await asyncio.gather(sheet_ready, producer, writer)
+        await pipeline.flush()
+    except BaseException:
+        pipeline.cancel()
+        sheets_manager.pending_items.clear()
+        raise
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+    state.save(history_id)
+    return writer.result()
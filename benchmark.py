@@ -0,0 +1,236 @@
+import argparse
+import asyncio
+import json
+import os.path
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+
+from async_pipeline import run_sync
+from email_cache import EmailCache
+from fake_google import FakeBackend, FakeGmail, FakeProvider, FakeSheets
+from rate_limit import gmail_quota, sheets_quota
+from refactored_process import GmailManager, GoogleSheets, iter_parsed_sales
+from sale_index import SaleIndex
+from sync_state import SyncState
+
+# Call counts are deterministic up to retries, so they get a much tighter tolerance than timings.
+CALL_TOLERANCE = 0.05
+THROUGHPUT_TOLERANCE = 0.25
+# Stages faster than this are too noisy to compare throughput on.
+MIN_STAGE_SECONDS = 0.5
+NEW_MESSAGES = 100
+# Startup times are short and noisy, so they only count as regressed well beyond the baseline.
+STARTUP_TOLERANCE = 0.5
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class Stage:
+    """Measures wall time, CPU time, peak traced memory and fake API traffic for one `with` block."""
+
+    def __init__(self, report, name, backend):
+        self.report = report
+        self.name = name
+        self.backend = backend
+        self.items = 0
+
+    def __enter__(self):
+        self.before = self.backend.snapshot()
+        tracemalloc.reset_peak()
+        self.memory = tracemalloc.get_traced_memory()[0]
+        self.cpu = time.process_time()
+        self.wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        peak = tracemalloc.get_traced_memory()[1] - self.memory
+        after = self.backend.snapshot()
+        calls = {endpoint: count - self.before['calls'].get(endpoint, 0)
+                 for endpoint, count in after['calls'].items() if count != self.before['calls'].get(endpoint, 0)}
+        self.report[self.name] = {
+            'items': self.items,
+            'wall_seconds': round(wall, 4),
+            'cpu_seconds': round(cpu, 4),
+            'peak_memory_bytes': max(0, peak),
+            'items_per_second': round(self.items / wall, 1) if wall else None,
+            'api_calls': sum(calls.values()),
+            # Calls inside a batch share the batch's HTTP request.
+            'http_requests': sum(calls.values()) - sum(after['batched'].values())
+                             + sum(self.before['batched'].values()),
+            'calls': calls,
+            'response_bytes': sum(after['bytes'].values()) - sum(self.before['bytes'].values()),
+            'quota_errors': sum(after['errors'].values()) - sum(self.before['errors'].values()),
+        }
+
+
+def run(messages=1000, sale_ratio=0.6, latency=0.0, error_rate=0.0, batch_size=50, max_workers=4,
+        parse_workers=0, quota=False, seed=0):
+    """Run each pipeline stage, then a full and an incremental sync, against a generated mailbox."""
+    config = {'messages': messages, 'sale_ratio': sale_ratio, 'latency': latency, 'error_rate': error_rate,
+              'batch_size': batch_size, 'max_workers': max_workers, 'parse_workers': parse_workers,
+              'quota': quota, 'seed': seed}
+    backend = FakeBackend(latency=latency, error_rate=error_rate, seed=seed)
+    gmail = FakeGmail(backend, messages=messages, sale_ratio=sale_ratio, seed=seed)
+    stages = {}
+
+    def managers():
+        # Without --quota the limiters are off, so we measure the pipeline rather than Google's budget.
+        provider = FakeProvider(gmail, FakeSheets(backend))
+        return (GmailManager(batch_size=batch_size, max_workers=max_workers, credentials_provider=provider,
+                             limiter=gmail_quota() if quota else None),
+                GoogleSheets(credentials_provider=provider, limiter=sheets_quota() if quota else None))
+
+    tracemalloc.start()
+    with tempfile.TemporaryDirectory() as workdir:
+        gmail_manager, sheets_manager = managers()
+        with Stage(stages, 'list', backend) as stage:
+            message_ids = list(gmail_manager.fetch_emails())
+            stage.items = len(message_ids)
+        with Stage(stages, 'fetch', backend) as stage:
+            sale_messages = list(gmail_manager.iter_sale_messages(message_ids))
+            stage.items = len(sale_messages)
+        with Stage(stages, 'parse', backend) as stage:
+            sales = list(iter_parsed_sales(sale_messages, parse_workers))
+            stage.items = len(sales)
+        del sale_messages
+        with Stage(stages, 'write', backend) as stage:
+            sale_index = SaleIndex(os.path.join(workdir, 'write.sqlite3'))
+            sheets_manager.queue_items([sale for sale in sales if not sale_index.is_recorded(sale)])
+            sale_index.add(sheets_manager.flush("Sheet1"))
+            stage.items = len(sale_index)
+            sale_index.close()
+
+        gmail_manager, sheets_manager = managers()
+        state = SyncState(os.path.join(workdir, 'sync_state.json'))
+        sale_index = SaleIndex(os.path.join(workdir, 'sync.sqlite3'))
+        email_cache = EmailCache(os.path.join(workdir, 'email_cache.sqlite3'))
+        with Stage(stages, 'full_sync', backend) as stage:
+            asyncio.run(run_sync(gmail_manager, sheets_manager, state, sale_index, full_resync=True,
+                                 parse_workers=parse_workers, email_cache=email_cache))
+            stage.items = len(sale_index)
+        for index in range(NEW_MESSAGES):
+            gmail.add_message(gmail_manager.sale_subject, f"New item {index}", 10.0 + index)
+        with Stage(stages, 'incremental_sync', backend) as stage:
+            asyncio.run(run_sync(gmail_manager, sheets_manager, state, sale_index, parse_workers=parse_workers,
+                                 email_cache=email_cache))
+            stage.items = len(sale_index) - stages['full_sync']['items']
+        # Every message is cached by now, so a full resync should only list the mailbox.
+        with Stage(stages, 'cached_resync', backend) as stage:
+            asyncio.run(run_sync(gmail_manager, sheets_manager, state, sale_index, full_resync=True,
+                                 parse_workers=parse_workers, email_cache=email_cache))
+            stage.items = len(email_cache)
+        email_cache.close()
+        sale_index.close()
+    tracemalloc.stop()
+    return {'config': config, 'stages': stages}
+
+
+def startup(repeat=3):
+    """Time fresh interpreters running the CLI's cheap paths, and count the modules each one imports."""
+    store = os.path.join(tempfile.mkdtemp(), 'sales.sqlite3')
+    commands = {
+        'interpreter': ['-c', 'pass'],
+        'cli_help': ['vinted_sync.py', '--help'],
+        'cli_report': ['vinted_sync.py', 'report', '--store', store],
+        'import_pipeline': ['-c', 'import refactored_process'],
+    }
+    report = {}
+    for name, command in commands.items():
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            subprocess.run([sys.executable, *command], cwd=HERE, check=True, stdout=subprocess.DEVNULL)
+            timings.append(time.perf_counter() - started)
+        # -X importtime writes one stderr line per imported module, plus a header.
+        imports = subprocess.run([sys.executable, '-X', 'importtime', *command], cwd=HERE, check=True,
+                                 stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True).stderr
+        report[name] = {'wall_seconds': round(min(timings), 4),
+                        'modules': sum(line.startswith('import time:') for line in imports.splitlines()) - 1}
+    return report
+
+
+def best_of(reports):
+    """Merge repeated runs, keeping the fastest run of each stage."""
+    stages = {name: min((report['stages'][name] for report in reports), key=lambda stage: stage['wall_seconds'])
+              for name in reports[0]['stages']}
+    return {'config': dict(reports[0]['config'], repeat=len(reports)), 'stages': stages}
+
+
+def compare(report, baseline, call_tolerance=CALL_TOLERANCE, throughput_tolerance=THROUGHPUT_TOLERANCE,
+            startup_tolerance=STARTUP_TOLERANCE):
+    """Return a list of regressions in call count, throughput or startup against a baseline report."""
+    regressions = []
+    for name, command in report.get('startup', {}).items():
+        old = baseline.get('startup', {}).get(name)
+        if old is None:
+            continue
+        if command['modules'] > old['modules'] * (1 + call_tolerance):
+            regressions.append(f"startup {name}: {command['modules']} modules imported, baseline {old['modules']}")
+        if command['wall_seconds'] > old['wall_seconds'] * (1 + startup_tolerance):
+            regressions.append(f"startup {name}: {command['wall_seconds']}s, baseline {old['wall_seconds']}s")
+    for name, stage in report['stages'].items():
+        old = baseline['stages'].get(name)
+        if old is None:
+            continue
+        if stage['api_calls'] > old['api_calls'] * (1 + call_tolerance):
+            regressions.append(f"{name}: {stage['api_calls']} API calls, baseline {old['api_calls']}")
+        if stage['http_requests'] > old['http_requests'] * (1 + call_tolerance):
+            regressions.append(f"{name}: {stage['http_requests']} HTTP requests, baseline {old['http_requests']}")
+        if old['wall_seconds'] < MIN_STAGE_SECONDS or not old['items_per_second']:
+            continue
+        if stage['items_per_second'] < old['items_per_second'] * (1 - throughput_tolerance):
+            regressions.append(f"{name}: {stage['items_per_second']} items/s, baseline {old['items_per_second']}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the sync pipeline against an in-process fake Gmail and Sheets.")
+    parser.add_argument('--messages', type=int, default=1000, help="size of the generated mailbox")
+    parser.add_argument('--sale-ratio', type=float, default=0.6, help="share of the mailbox that are sale emails")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds each API call or batch takes")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="probability that a call fails with a 429")
+    parser.add_argument('--batch-size', type=int, default=50)
+    parser.add_argument('--max-workers', type=int, default=4)
+    parser.add_argument('--parse-workers', type=int, default=0)
+    parser.add_argument('--quota', action='store_true', help="apply the real Gmail and Sheets quota limiters")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3, help="runs to take the fastest of, per stage")
+    parser.add_argument('--output', help="write the JSON report to this file")
+    parser.add_argument('--baseline', help="exit with status 1 if this report regresses against the given one")
+    parser.add_argument('--call-tolerance', type=float, default=CALL_TOLERANCE)
+    parser.add_argument('--throughput-tolerance', type=float, default=THROUGHPUT_TOLERANCE)
+    parser.add_argument('--startup', action='store_true',
+                        help="also time the vinted-sync CLI's startup in fresh interpreters")
+    parser.add_argument('--startup-tolerance', type=float, default=STARTUP_TOLERANCE)
+    args = parser.parse_args()
+
+    # The pipeline prints a line per appended sale; keep stdout for the report.
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        report = best_of([run(messages=args.messages, sale_ratio=args.sale_ratio, latency=args.latency,
+                              error_rate=args.error_rate, batch_size=args.batch_size,
+                              max_workers=args.max_workers, parse_workers=args.parse_workers, quota=args.quota,
+                              seed=args.seed)
+                          for _ in range(args.repeat)])
+    if args.startup:
+        report['startup'] = startup(args.repeat)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as report_file:
+            report_file.write(output + '\n')
+    print(output)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get('config') != report['config']:
+            print("Warning: baseline was recorded with a different configuration.", file=sys.stderr)
+        regressions = compare(report, baseline, args.call_tolerance, args.throughput_tolerance,
+                              args.startup_tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,178 @@
+import argparse
+import asyncio
+import json
+import math
+import os.path
+import signal
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from async_pipeline import run_sync
+from email_cache import CACHE_FILE, EmailCache
+from google_clients import CLIENT_SECRETS_FILE, SCOPES, TOKEN_FILE, CredentialsProvider
+from rate_limit import GMAIL_UNITS_PER_SECOND, SHEETS_REQUESTS_PER_MINUTE, fair_share, gmail_quota, sheets_quota
+from refactored_process import DEFAULT_QUERY, SALE_SUBJECT, GmailManager, GoogleSheets
+from sale_index import INDEX_FILE, SaleIndex
+from sales_store import STORE_FILE, SalesStore
+from sync_state import STATE_FILE, SyncState
+
+CONFIG_FILE = 'accounts.json'
+DATA_DIR = 'accounts'
+INTERVAL = 300
+WORKERS = 4
+# Failed accounts back off exponentially, up to this many seconds between attempts.
+MAX_BACKOFF = 3600
+
+# accounts.json:
+# {
+#   "interval": 300, "workers": 4, "data_dir": "accounts",
+#   "accounts": [
+#     {"name": "shop-a", "spreadsheet_id": "...", "query": "...", "subject": "...", "interval": 600,
+#      "token": "accounts/shop-a/token.json", "client_secrets": "credentials.json"}
+#   ]
+# }
+# Only name and spreadsheet_id are required. Each account keeps its token, sync state,
+# sale index, email cache and sales store under <data_dir>/<name>/.
+
+
+class Account:
+    """One seller account: its own credentials, spreadsheet, quota budget and local state."""
+
+    def __init__(self, config, data_dir=DATA_DIR, interval=INTERVAL, gmail_rate=GMAIL_UNITS_PER_SECOND,
+                 sheets_rate=SHEETS_REQUESTS_PER_MINUTE):
+        self.name = config['name']
+        self.spreadsheet_id = config['spreadsheet_id']
+        self.query = config.get('query', DEFAULT_QUERY)
+        self.sale_subject = config.get('subject', SALE_SUBJECT)
+        self.interval = config.get('interval', interval)
+        directory = os.path.join(data_dir, self.name)
+        os.makedirs(directory, exist_ok=True)
+        self.provider = CredentialsProvider(token_path=config.get('token', os.path.join(directory, TOKEN_FILE)),
+                                            client_secrets_path=config.get('client_secrets', CLIENT_SECRETS_FILE),
+                                            scopes=config.get('scopes', SCOPES))
+        self.gmail_limiter = gmail_quota(gmail_rate)
+        self.sheets_limiter = sheets_quota(sheets_rate)
+        self.state = SyncState(os.path.join(directory, STATE_FILE))
+        self.sale_index = SaleIndex(os.path.join(directory, INDEX_FILE))
+        self.email_cache = EmailCache(os.path.join(directory, CACHE_FILE))
+        self.sales_store = SalesStore(os.path.join(directory, STORE_FILE))
+        self.gmail_manager = None
+        self.sheets_manager = None
+        self.next_run = 0.0
+        self.failures = 0
+
+    def connect(self):
+        """Build the API clients once; later cycles reuse them and their pooled connections."""
+        if self.gmail_manager is None:
+            self.gmail_manager = GmailManager(query=self.query, sale_subject=self.sale_subject,
+                                              credentials_provider=self.provider, limiter=self.gmail_limiter)
+            self.sheets_manager = GoogleSheets(credentials_provider=self.provider, limiter=self.sheets_limiter,
+                                               spreadsheet_id=self.spreadsheet_id)
+
+    def sync(self):
+        self.connect()
+        # Refreshes the token ahead of expiry and saves it.
+        self.provider.get_credentials()
+        # The sheet may have been edited since the last cycle; the saved row counts get re-checked.
+        self.sheets_manager.refresh_metadata()
+        return asyncio.run(run_sync(self.gmail_manager, self.sheets_manager, self.state, self.sale_index,
+                                    email_cache=self.email_cache, sales_store=self.sales_store))
+
+    def close(self):
+        self.sale_index.close()
+        self.email_cache.close()
+        self.sales_store.close()
+
+
+class Scheduler:
+    """Runs each account's incremental sync every `interval` seconds on a pool of worker threads.
+
+    An account never runs twice at once, and the most overdue accounts go first.
+    """
+
+    def __init__(self, accounts, workers=WORKERS):
+        self.accounts = accounts
+        self.workers = workers
+        self.stopping = threading.Event()
+
+    def stop(self, *args):
+        self.stopping.set()
+
+    def sync_account(self, account, once=False):
+        started = time.monotonic()
+        try:
+            found = account.sync()
+        except Exception as error:
+            account.failures += 1
+            delay = min(MAX_BACKOFF, account.interval * 2 ** account.failures)
+            print(f"[{account.name}] Sync failed ({error}); retrying in {delay:.0f}s.")
+        else:
+            account.failures = 0
+            delay = account.interval
+            print(f"[{account.name}] Synced in {time.monotonic() - started:.1f}s"
+                  f"{'' if found else ', no new emails'}.")
+        account.next_run = math.inf if once else time.monotonic() + delay
+
+    def run(self, once=False):
+        running = {}
+        if once:
+            for account in self.accounts:
+                account.next_run = 0.0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while not self.stopping.is_set():
+                now = time.monotonic()
+                idle = [account for account in self.accounts if account not in running.values()]
+                due = sorted((account for account in idle if account.next_run <= now), key=lambda a: a.next_run)
+                for account in due[:self.workers - len(running)]:
+                    running[executor.submit(self.sync_account, account, once)] = account
+                if not running and once:
+                    break
+                waiting = [account.next_run for account in self.accounts if account not in running.values()]
+                timeout = max(0.0, min(waiting, default=math.inf) - now)
+                if len(running) >= self.workers:
+                    # Overdue accounts cannot start before a worker frees up, so wait for one.
+                    timeout = math.inf
+                if running:
+                    done, _ = wait(running, timeout=None if timeout == math.inf else timeout,
+                                   return_when=FIRST_COMPLETED)
+                    for future in done:
+                        running.pop(future)
+                else:
+                    self.stopping.wait(timeout)
+            # Let syncs in progress finish; their checkpoint only moves when they complete.
+            wait(running)
+
+
+def load_accounts(path=CONFIG_FILE):
+    with open(path) as config_file:
+        config = json.load(config_file)
+    gmail_rate, sheets_rate = fair_share(len(config['accounts']))
+    accounts = [Account(account, data_dir=config.get('data_dir', DATA_DIR),
+                        interval=config.get('interval', INTERVAL), gmail_rate=gmail_rate, sheets_rate=sheets_rate)
+                for account in config['accounts']]
+    return accounts, config.get('workers', WORKERS)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Keep many Vinted seller accounts synced to their own sheets.")
+    parser.add_argument('config', nargs='?', default=CONFIG_FILE, help="JSON file listing the accounts")
+    parser.add_argument('--once', action='store_true', help="sync every account once and exit")
+    parser.add_argument('--authorize', action='store_true',
+                        help="run the OAuth consent flow for accounts without a token, one by one, and exit")
+    args = parser.parse_args()
+
+    accounts, workers = load_accounts(args.config)
+    try:
+        if args.authorize:
+            for account in accounts:
+                print(f"[{account.name}] Authorizing...")
+                account.provider.get_credentials()
+        else:
+            scheduler = Scheduler(accounts, workers)
+            signal.signal(signal.SIGINT, scheduler.stop)
+            signal.signal(signal.SIGTERM, scheduler.stop)
+            scheduler.run(once=args.once)
+    finally:
+        for account in accounts:
+            account.close()
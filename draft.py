@@ -1,74 +1,154 @@
+import argparse
 import base64
+import csv
+import json
+from concurrent.futures import ThreadPoolExecutor
 from email.message import EmailMessage
-import os.path
-import google.auth
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
-
-SCOPES = ["https://www.googleapis.com/auth/gmail.readonly"]
-
-def gmail_create_draft():
-  """Create and insert a draft email.
-   Print the returned draft's message and id.
-   Returns: Draft object, including draft id and message meta data.
-
-  Load pre-authorized user credentials from the environment.
-  TODO(developer) - See https://developers.google.com/identity
-  for guides on implementing OAuth2 for the application.
+
+from api_calls import MAX_RETRIES, backoff, execute, is_rate_limited
+from google_clients import CLIENT_SECRETS_FILE, CredentialsProvider
+from rate_limit import GMAIL_LIMITER, GMAIL_METHOD_UNITS
+
+# Drafting needs the compose scope, which the sync never does; it gets its own token so
+# token.json keeps its read-only Gmail access.
+COMPOSE_SCOPES = ["https://www.googleapis.com/auth/gmail.compose"]
+COMPOSE_TOKEN_FILE = "token_compose.json"
+DRAFT_CREATE_UNITS = GMAIL_METHOD_UNITS["gmail.users.drafts.create"]
+# 25 drafts cost 250 units, one second of a user's Gmail quota.
+DRAFT_BATCH_SIZE = 25
+MAX_WORKERS = 4
+
+_compose_provider = None
+
+
+def compose_provider():
+  """The process-wide provider for drafting, authorized once and shared by every batch."""
+  global _compose_provider
+  if _compose_provider is None:
+    _compose_provider = CredentialsProvider(token_path=COMPOSE_TOKEN_FILE, client_secrets_path=CLIENT_SECRETS_FILE,
+                                            scopes=COMPOSE_SCOPES)
+  return _compose_provider
+
+
+class DraftTemplate:
+  """Subject and body with str.format fields, filled in from each recipient's fields.
+
+  A sale from the sales store, for example, provides {name}, {price}, {currency} and {date}.
   """
-  creds = None
-  if os.path.exists("token.json"):
-    creds = Credentials.from_authorized_user_file("token.json", SCOPES)
-    # If there are no (valid) credentials available, let the user log in.
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file(
-                "credentials.json", SCOPES
-    )
-            creds = flow.run_local_server(port=0)
-    # Save the credentials for the next run
-        with open("token.json", "w") as token:
-            token.write(creds.to_json())
-
-  try:
-    # create gmail api client
-    service = build("gmail", "v1", credentials=creds)
 
+  def __init__(self, subject, body, sender=None):
+    self.subject = subject
+    self.body = body
+    self.sender = sender
+
+  def render(self, fields):
     message = EmailMessage()
+    message.set_content(self.body.format_map(fields))
+    message["To"] = fields["to"]
+    if self.sender:
+      message["From"] = self.sender
+    message["Subject"] = self.subject.format_map(fields)
+    return {"message": {"raw": base64.urlsafe_b64encode(message.as_bytes()).decode()}}
 
-    message.set_content("This is automated draft mail")
 
-    message["To"] = "gduser1@workspacesamples.dev"
-    message["From"] = "filip.mihai.muntean@gmail.com"
-    message["Subject"] = "Automated draft"
+def render_drafts(recipients, templates):
+  """Render every recipient's draft body in one pass.
 
-    # encoded message
-    encoded_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
+  `recipients` is an iterable of mappings with a "to" address plus the template's fields.
+  `templates` is a DraftTemplate, or a dict of them picked by each recipient's "template" key.
+  Returns (recipients, bodies, results): a recipient that cannot be rendered gets its error in
+  `results` and None as its body.
+  """
+  recipients = list(recipients)
+  bodies = [None] * len(recipients)
+  results = [None] * len(recipients)
+  for position, recipient in enumerate(recipients):
+    try:
+      template = templates[recipient["template"]] if isinstance(templates, dict) else templates
+      bodies[position] = template.render(recipient)
+    except (KeyError, IndexError, ValueError) as error:
+      results[position] = {"to": recipient.get("to"), "draft_id": None, "error": f"cannot render: {error!r}"}
+  return recipients, bodies, results
+
+
+def _execute_draft_batch(service, recipients, bodies, positions, results, limiter):
+  # drafts.create is not idempotent: a call that failed with a server or connection error may
+  # still have created its draft. Only rate-limit rejections, which create nothing, are retried.
+  attempt = 0
+  while True:
+    errors = {}
+
+    def callback(request_id, response, exception):
+      position = int(request_id)
+      if exception is not None:
+        errors[position] = exception
+      else:
+        results[position] = {"to": recipients[position]["to"], "draft_id": response["id"], "error": None}
+
+    batch = service.new_batch_http_request(callback=callback)
+    for position in positions:
+      batch.add(service.users().drafts().create(userId="me", body=bodies[position]), request_id=str(position))
+    try:
+      execute(batch, limiter, cost=len(positions) * DRAFT_CREATE_UNITS, max_retries=0)
+    except Exception as error:
+      errors = {position: error for position in positions if results[position] is None}
+    retry = sorted(position for position, error in errors.items() if is_rate_limited(error) and attempt < MAX_RETRIES)
+    for position, error in errors.items():
+      if position not in retry:
+        results[position] = {"to": recipients[position]["to"], "draft_id": None, "error": str(error)}
+    if not retry:
+      return
+    backoff(errors[retry[0]], attempt, limiter, "gmail.users.drafts.create")
+    positions = retry
+    attempt += 1
+
+
+def create_drafts(recipients, templates, service=None, batch_size=DRAFT_BATCH_SIZE, max_workers=MAX_WORKERS,
+                  limiter=GMAIL_LIMITER):
+  """Create a Gmail draft for every recipient, with batched calls on one shared client.
+
+  Returns one {"to", "draft_id", "error"} result per recipient, in order. A draft that
+  cannot be rendered or created gets its error there instead of stopping the others.
+  """
+  if service is None:
+    service = compose_provider().service("gmail", "v1")
+  recipients, bodies, results = render_drafts(recipients, templates)
+  pending = [position for position, body in enumerate(bodies) if body is not None]
+  chunks = [pending[start:start + batch_size] for start in range(0, len(pending), batch_size)]
+  with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    futures = [executor.submit(_execute_draft_batch, service, recipients, bodies, chunk, results, limiter)
+               for chunk in chunks]
+    for future in futures:
+      future.result()
+  return results
 
-    create_message = {"message": {"raw": encoded_message}}
-    # pylint: disable=E1101
-    draft = (
-        service.users()
-        .drafts()
-        .create(userId="me", body=create_message)
-        .execute()
-    )
 
-    print(f'Draft id: {draft["id"]}\nDraft message: {draft["message"]}')
+def load_recipients(path):
+  """Read recipients from a CSV file with a header row, or from a JSON list of objects."""
+  with open(path, newline="") as recipients_file:
+    if path.endswith(".json"):
+      return json.load(recipients_file)
+    return list(csv.DictReader(recipients_file))
 
-  except HttpError as error:
-    print(f"An error occurred: {error}")
-    draft = None
 
-  return draft
+def draft_from_args(args):
+  with open(args.body) as body_file:
+    template = DraftTemplate(args.subject, body_file.read(), args.sender)
+  results = create_drafts(load_recipients(args.recipients), template)
+  for result in results:
+    if result["error"]:
+      print(f'{result["to"]}: {result["error"]}')
+    else:
+      print(f'{result["to"]}: draft {result["draft_id"]}')
+  created = sum(1 for result in results if not result["error"])
+  print(f"Created {created} of {len(results)} drafts.")
+  return results
 
 
 if __name__ == "__main__":
-  gmail_create_draft()
\ No newline at end of file
+  parser = argparse.ArgumentParser(description="Create a Gmail draft for each recipient from a template.")
+  parser.add_argument("recipients", help="CSV (with a 'to' column) or JSON file of recipients and their fields")
+  parser.add_argument("--subject", required=True, help="subject template, e.g. 'Thanks for buying {name}!'")
+  parser.add_argument("--body", required=True, help="file holding the body template")
+  parser.add_argument("--from", dest="sender", help="From address (default: the authorized account)")
+  draft_from_args(parser.parse_args())
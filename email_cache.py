@@ -0,0 +1,85 @@
+import sqlite3
+
+from email_parsing import get_message_subject
+
+CACHE_FILE = 'email_cache.sqlite3'
+MAX_ENTRIES = 200_000
+
+
+class EmailCache:
+    """On-disk cache of what each Gmail message parsed to, so re-runs skip fetching it again.
+
+    Gmail messages never change once delivered, so entries are keyed on the message ID and
+    never go stale. Every message is stored with its subject: sales with their parsed record,
+    anything else as a negative entry, which only stands while the sale subject is unchanged.
+    Once the cache holds more than `max_entries`, the least recently used entries are evicted.
+    """
+
+    def __init__(self, path=CACHE_FILE, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        # Used by one sync at a time, but not always from the thread that opened it.
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS messages (message_id TEXT PRIMARY KEY, subject TEXT, name TEXT, "
+                "price REAL, sale_date TEXT, currency TEXT, last_used INTEGER NOT NULL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS messages_last_used ON messages (last_used)")
+        self.size, clock = self.connection.execute("SELECT COUNT(*), MAX(last_used) FROM messages").fetchone()
+        self.clock = clock or 0
+
+    def __len__(self):
+        return self.size
+
+    def lookup(self, message_ids, sale_subject):
+        """Return (sales, non_sale_ids, missing_ids) for `message_ids`, marking the hits as recently used.
+
+        `sales` maps message ID to the cached sale record.
+        """
+        rows = {}
+        message_ids = list(message_ids)
+        # SQLite limits the number of bound parameters per statement.
+        for start in range(0, len(message_ids), 500):
+            chunk = message_ids[start:start + 500]
+            rows.update((row[0], row) for row in self.connection.execute(
+                "SELECT message_id, subject, name, price, sale_date, currency FROM messages "
+                f"WHERE message_id IN ({', '.join('?' * len(chunk))})", chunk))
+        sales, non_sale_ids, missing_ids = {}, [], []
+        for message_id in message_ids:
+            row = rows.get(message_id)
+            if row is None or (row[1] == sale_subject and row[2] is None):
+                missing_ids.append(message_id)
+            elif row[1] != sale_subject:
+                non_sale_ids.append(message_id)
+            else:
+                sales[message_id] = {'message_id': message_id, 'name': row[2], 'price': row[3],
+                                     'date': row[4], 'currency': row[5]}
+        if rows:
+            self.clock += 1
+            with self.connection:
+                self.connection.executemany("UPDATE messages SET last_used = ? WHERE message_id = ?",
+                                            ((self.clock, message_id) for message_id in rows))
+        return sales, non_sale_ids, missing_ids
+
+    def add_sales(self, sales, sale_subject):
+        self._store((sale['message_id'], sale_subject, sale['name'], sale['price'], sale.get('date'),
+                     sale.get('currency')) for sale in sales)
+
+    def add_non_sales(self, messages):
+        """Store negative entries for metadata-format messages whose subject is not a sale."""
+        self._store((msg['id'], get_message_subject(msg), None, None, None, None) for msg in messages)
+
+    def _store(self, rows):
+        self.clock += 1
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO messages (message_id, subject, name, price, sale_date, currency, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", ((*row, self.clock) for row in rows))
+            self.size = self.connection.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+            if self.size > self.max_entries:
+                self.connection.execute(
+                    "DELETE FROM messages WHERE message_id IN "
+                    "(SELECT message_id FROM messages ORDER BY last_used LIMIT ?)", (self.size - self.max_entries,))
+                self.size = self.max_entries
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,213 @@
+import base64
+import html
+import re
+import sys
+from datetime import datetime, timezone
+from email.utils import parseaddr
+
+from instrumentation import metrics
+
+try:
+    import lxml.html
+except ImportError:  # lxml is optional; BeautifulSoup's html.parser is the fallback.
+    lxml = None
+# BeautifulSoup is imported on first use: sale emails on the usual template never need it.
+
+_TAG = re.compile(r'<[^>]*>')
+# Markup BeautifulSoup never reads as text: comments (MSO conditionals included) and raw-text elements.
+_HIDDEN = re.compile(r'<!--.*?(?:-->|$)|<(script|style)\b.*?(?:</\1\s*>|$)', re.S | re.I)
+_PARAGRAPH = re.compile(r'<p\b[^>]*>(.*?)</p\s*>', re.S | re.I)
+_SPAN = re.compile(r'<span\b[^>]*>(.*?)</span\s*>', re.S | re.I)
+# Prices end in a space and a currency symbol, e.g. "12.50 €".
+CURRENCIES = {'€': 'EUR', '£': 'GBP', '$': 'USD'}
+_ITEM_PRICE = re.compile(r'<td\b[^>]*>Item price:</td\s*>.*?<td\b[^>]*>(.*?)</td\s*>', re.S | re.I)
+
+
+def get_message_subject(msg):
+    """Extracts the subject (title) of the email from the headers."""
+    for header in msg['payload']['headers']:
+        if header['name'] == 'Subject':
+            return header['value']
+    return "No Subject"
+
+
+def get_message_sender(msg):
+    """Returns the address in the From header, lower-cased, or "" if there is none."""
+    for header in msg['payload']['headers']:
+        if header['name'] == 'From':
+            return parseaddr(header['value'])[1].lower()
+    return ""
+
+
+def is_sale_message(msg, sale_subject, sale_sender=None):
+    """True if a metadata-format message has the sale subject and, when `sale_sender` is set, comes from it.
+
+    `sale_sender` follows Gmail's from: operator: "@vinted.nl" matches any address at that domain.
+    """
+    if get_message_subject(msg) != sale_subject:
+        return False
+    if not sale_sender:
+        return True
+    sender, sale_sender = get_message_sender(msg), sale_sender.lower()
+    return sender.endswith(sale_sender) if sale_sender.startswith('@') else sale_sender in sender
+
+
+def _find_part(payload, mime_type):
+    if payload.get('mimeType') == mime_type and payload.get('body', {}).get('data'):
+        return payload
+    for part in payload.get('parts', []):
+        found = _find_part(part, mime_type)
+        if found:
+            return found
+    return None
+
+
+def get_message_html(msg):
+    """Decodes the HTML part of the message (or its only body) without parsing it."""
+    payload = msg['payload']
+    part = _find_part(payload, 'text/html') or _find_part(payload, 'text/plain')
+    data = part['body']['data'] if part else payload['body']['data']
+    return base64.urlsafe_b64decode(data).decode('utf-8')
+
+
+def get_message_body(msg):
+    """Extracts the body of the message, handling different types of content."""
+    from bs4 import BeautifulSoup
+    if 'parts' in msg['payload']:
+        for part in msg['payload']['parts']:
+            if part['mimeType'] == 'text/plain':
+                return base64.urlsafe_b64decode(part['body']['data']).decode('utf-8')
+            elif part['mimeType'] == 'text/html':
+                html_body = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8')
+                return BeautifulSoup(html_body, 'html.parser').get_text()
+    else:
+        return base64.urlsafe_b64decode(msg['payload']['body']['data']).decode('utf-8')
+    return None
+
+
+def _strip_text(fragment):
+    # Same result as BeautifulSoup's get_text(strip=True) for a fragment without nested tags of its own kind.
+    return ''.join(html.unescape(piece).strip() for piece in _TAG.split(fragment))
+
+
+def _extract_prescan(html_body):
+    """Pull the item and price straight out of the known Vinted template, or return None.
+
+    Anything the regexes could read differently from BeautifulSoup, such as a second
+    price label, gives up and leaves the email to the full parser.
+    """
+    # A comment still splits the text around it into separate strings, so it becomes an empty tag.
+    html_body = _HIDDEN.sub(lambda hidden: '<!>' if hidden.group().startswith('<!--') else '', html_body)
+    if html_body.count('Item price:') != 1:
+        return None
+    item_name = None
+    for paragraph in _PARAGRAPH.finditer(html_body):
+        content = paragraph.group(1)
+        if '<p' in content.lower():
+            return None
+        if "Your sale of" in html.unescape(_TAG.sub('', content)):
+            span = _SPAN.search(content)
+            if not span or '<span' in span.group(1).lower():
+                return None
+            item_name = _strip_text(span.group(1)).split("was completed")[0].strip()
+            break
+    price = _ITEM_PRICE.search(html_body)
+    if item_name is None or not price or '<td' in price.group(1).lower():
+        return None
+    return item_name, _strip_text(price.group(1))
+
+
+def _lxml_strings(element):
+    if isinstance(element.tag, str) and element.text:
+        yield element.text
+    for child in element:
+        yield from _lxml_strings(child)
+        if child.tail:
+            yield child.tail
+
+
+def _lxml_string(element):
+    # Mirrors BeautifulSoup's Tag.string: the text of an element with exactly one child.
+    if len(element) == 0:
+        return element.text
+    if len(element) == 1 and not element.text and not element[0].tail:
+        return _lxml_string(element[0])
+    return None
+
+
+def _extract_lxml(html_body):
+    root = lxml.html.fromstring(html_body)
+    item_name = ""
+    for p_tag in root.iter('p'):
+        if "Your sale of" in ''.join(_lxml_strings(p_tag)):
+            item_name_span = next(p_tag.iter('span'), None)
+            if item_name_span is not None:
+                text = ''.join(piece.strip() for piece in _lxml_strings(item_name_span))
+                item_name = text.split("was completed")[0].strip()
+            break
+    price = ""
+    for td in root.iter('td'):
+        if _lxml_string(td) == 'Item price:':
+            price_cell = td.xpath('following::td[1]')
+            if price_cell:
+                price = ''.join(piece.strip() for piece in _lxml_strings(price_cell[0]))
+            break
+    return item_name, price
+
+
+def _extract_soup(html_body):
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html_body, 'html.parser')
+    item_name = ""
+    for p_tag in soup.find_all('p'):
+        if "Your sale of" in p_tag.get_text():
+            item_name_span = p_tag.find('span')
+            if item_name_span:
+                item_name = item_name_span.get_text(strip=True).split("was completed")[0].strip()
+            break
+    price_info = soup.find('td', string='Item price:')
+    price = price_info.find_next('td').get_text(strip=True) if price_info else ""
+    return item_name, price
+
+
+def extract_item_and_price(html_body):
+    """Extracts the item name and price from the HTML email body.
+
+    The known Vinted template is handled with a regex pre-scan that builds no tree. Anything
+    else is parsed once, with lxml when it is installed and BeautifulSoup otherwise.
+    """
+    result = _extract_prescan(html_body)
+    if result is None:
+        result = _extract_lxml(html_body) if lxml is not None else _extract_soup(html_body)
+    return result
+
+
+def parse_sale(msg):
+    """Decode and parse a full sale email into a sale record; safe to run in a worker process."""
+    with metrics.stage('decode'):
+        html_body = get_message_html(msg)
+    with metrics.stage('parse'):
+        item, price = extract_item_and_price(html_body)
+    metrics.add_items('parse', 1)
+    if price.startswith('\''):
+        price = price[1:]
+    # internalDate is when Gmail received the email, in milliseconds since the epoch (UTC).
+    received = msg.get('internalDate')
+    date = datetime.fromtimestamp(int(received) / 1000, timezone.utc).date().isoformat() if received else None
+    return {'message_id': msg['id'], 'name': item, 'price': float(price[:-2]), 'date': date,
+            'currency': CURRENCIES.get(price[-1], price[-1])}
+
+
+if __name__ == "__main__":
+    # Parity check: python email_parsing.py saved_email.html ...
+    mismatches = 0
+    for path in sys.argv[1:]:
+        with open(path, encoding='utf-8') as saved_email:
+            html_body = saved_email.read()
+        expected = _extract_soup(html_body)
+        actual = extract_item_and_price(html_body)
+        if actual != expected:
+            mismatches += 1
+            print(f"{path}: fast path returned {actual!r}, BeautifulSoup returned {expected!r}")
+    print(f"{len(sys.argv) - 1 - mismatches}/{len(sys.argv) - 1} emails match.")
+    sys.exit(1 if mismatches else 0)
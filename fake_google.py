@@ -0,0 +1,427 @@
+import base64
+import html
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+SALE_SUBJECT = "This order is completed"
+OTHER_SUBJECTS = ["Your item has been shipped", "Bundle discount for you", "New message from a member"]
+SALE_TEMPLATE = (
+    '<html><body><table><tr><td>'
+    '<p style="margin:0">Hi seller,</p>'
+    '<p style="margin:0">Your sale of <span style="font-weight:bold">{item} was completed</span>.</p>'
+    '<table><tr><td>Item price:</td><td style="text-align:right">{price:.2f} €</td></tr>'
+    '<tr><td>Shipping:</td><td>2.50 €</td></tr></table>'
+    '</td></tr></table></body></html>'
+)
+OTHER_TEMPLATE = '<html><body><p>{subject}</p><p>Thanks for using Vinted.</p></body></html>'
+ITEMS = ["Nike Air Max", "Levi's 501 jeans", "Zara wool coat", "Adidas hoodie", "H&M summer dress",
+         "Ray-Ban sunglasses", "Converse All Star", "Patagonia fleece"]
+SENDER = 'no-reply@vinted.nl'
+# Size of a new tab's grid when addSheet does not give one, as in the real API.
+GRID_ROWS = 1000
+GRID_COLUMNS = 26
+# Generated emails arrive an hour apart from the start of 2024.
+EPOCH = 1704067200
+_RANGE = re.compile(r"^(?:'?(?P<title>.+?)'?!)?(?P<c1>[A-Z]+)(?P<r1>\d*)(?::(?P<c2>[A-Z]+)(?P<r2>\d*))?$")
+
+
+def _quota_error(reason='rateLimitExceeded'):
+    resp = httplib2.Response({'status': 429, 'retry-after': '0'})
+    resp.reason = 'Too Many Requests'
+    return HttpError(resp, json.dumps({'error': {'errors': [{'reason': reason}]}}).encode())
+
+
+def _http_error(status, message):
+    resp = httplib2.Response({'status': status})
+    resp.reason = message
+    return HttpError(resp, json.dumps({'error': {'message': message}}).encode())
+
+
+class FakeRequest:
+    def __init__(self, backend, method_id, handler):
+        self.backend = backend
+        self.methodId = method_id
+        self.handler = handler
+
+    def execute(self, http=None, num_retries=0):
+        return self.backend.call(self.methodId, self.handler)
+
+
+class FakeBatch:
+    def __init__(self, backend, callback):
+        self.backend = backend
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        self.requests.append((str(request_id if request_id is not None else len(self.requests)), request))
+
+    def execute(self, http=None):
+        def run():
+            for request_id, request in self.requests:
+                try:
+                    response, exception = self.backend.call(request.methodId, request.handler, batched=True), None
+                except HttpError as error:
+                    response, exception = None, error
+                self.callback(request_id, response, exception)
+        self.backend.call('batch', run)
+
+
+class FakeBackend:
+    """In-process stand-in for the Gmail and Sheets APIs, with latency and quota errors.
+
+    Every HTTP request sleeps `latency` seconds (a batch counts once) and every call fails
+    with a 429 at `error_rate`. Calls, calls made inside batches and response bytes are
+    counted per endpoint.
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.bytes = Counter()
+        self.errors = Counter()
+        self.batched = Counter()
+
+    def call(self, method_id, handler, batched=False):
+        with self.lock:
+            self.calls[method_id] += 1
+            self.batched[method_id] += batched
+            fail = self.error_rate and self.random.random() < self.error_rate
+        if not batched and self.latency:
+            time.sleep(self.latency)
+        if fail:
+            with self.lock:
+                self.errors[method_id] += 1
+            raise _quota_error()
+        response = handler()
+        if response is not None:
+            with self.lock:
+                self.bytes[method_id] += len(json.dumps(response))
+        return response
+
+    def snapshot(self):
+        with self.lock:
+            return {'calls': dict(self.calls), 'bytes': dict(self.bytes), 'errors': dict(self.errors),
+                    'batched': dict(self.batched)}
+
+
+class FakeGmail:
+    """Mailbox of generated Vinted emails served through the users() surface we use."""
+
+    def __init__(self, backend, messages=1000, sale_ratio=0.6, seed=0):
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.mailbox = {}
+        self.order = []
+        # (history_id, message_id, labels) for every message ever added; deleting one keeps its record.
+        self.added = []
+        self.history_id = 1000
+        generator = random.Random(seed)
+        for _ in range(messages):
+            is_sale = generator.random() < sale_ratio
+            subject = SALE_SUBJECT if is_sale else generator.choice(OTHER_SUBJECTS)
+            self.add_message(subject, f"{generator.choice(ITEMS)} #{generator.randrange(10 ** 6)}",
+                             round(generator.uniform(3, 120), 2))
+        self.created_drafts = []
+
+    def add_message(self, subject, item=None, price=None, sender=SENDER, labels=('INBOX',)):
+        with self.lock:
+            self.history_id += 1
+            message_id = f"{self.history_id:016x}"
+            self.mailbox[message_id] = (self.history_id, subject, item, price, sender)
+            self.added.append((self.history_id, message_id, set(labels)))
+            # Gmail lists newest first.
+            self.order.insert(0, message_id)
+            return message_id
+
+    def delete_message(self, message_id):
+        """Delete a message; like Gmail, history still lists it as added and messages.get returns 404."""
+        with self.lock:
+            del self.mailbox[message_id]
+            self.order.remove(message_id)
+
+    def _payload(self, message_id, format, metadata_headers):
+        history_id, subject, item, price, sender = self.mailbox[message_id]
+        headers = [{'name': 'Subject', 'value': subject}, {'name': 'From', 'value': sender}]
+        if format == 'metadata':
+            headers = [header for header in headers if not metadata_headers or header['name'] in metadata_headers]
+            return {'id': message_id, 'historyId': str(history_id), 'payload': {'headers': headers}}
+        if subject == SALE_SUBJECT:
+            body = SALE_TEMPLATE.format(item=html.escape(item), price=price)
+        else:
+            body = OTHER_TEMPLATE.format(subject=html.escape(subject))
+        data = base64.urlsafe_b64encode(body.encode('utf-8')).decode('ascii')
+        return {'id': message_id, 'historyId': str(history_id),
+                'internalDate': str((EPOCH + history_id * 3600) * 1000),
+                'payload': {'mimeType': 'text/html', 'headers': headers, 'body': {'data': data}}}
+
+    # Resource accessors mirroring service.users().messages() etc.
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self.backend, callback)
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return _Resource(self, {'list': self._list, 'get': self._get})
+
+    def history(self):
+        return _Resource(self, {'list': self._history})
+
+    def drafts(self):
+        return _Resource(self, {'create': self._create_draft})
+
+    def getProfile(self, userId):
+        return FakeRequest(self.backend, 'gmail.users.getProfile',
+                           lambda: {'emailAddress': 'seller@example.com', 'historyId': str(self.history_id)})
+
+    def watch(self, userId, body):
+        expiration = int((time.time() + 7 * 24 * 3600) * 1000)
+        return FakeRequest(self.backend, 'gmail.users.watch',
+                           lambda: {'historyId': str(self.history_id), 'expiration': str(expiration)})
+
+    def stop(self, userId):
+        return FakeRequest(self.backend, 'gmail.users.stop', lambda: None)
+
+    def _list(self, userId, q=None, maxResults=100, pageToken=None):
+        def handler():
+            phrase = re.search(r'subject:"([^"]+)"', q or '')
+            sender = re.search(r'from:(\S+)', q or '')
+            with self.lock:
+                ids = [message_id for message_id in self.order
+                       if (not phrase or phrase.group(1).lower() in self.mailbox[message_id][1].lower())
+                       and (not sender or sender.group(1).lower() in self.mailbox[message_id][4].lower())]
+            start = int(pageToken or 0)
+            page = ids[start:start + maxResults]
+            response = {'messages': [{'id': message_id, 'threadId': message_id} for message_id in page],
+                        'resultSizeEstimate': len(ids)}
+            if start + maxResults < len(ids):
+                response['nextPageToken'] = str(start + maxResults)
+            if not page:
+                del response['messages']
+            return response
+        return FakeRequest(self.backend, 'gmail.users.messages.list', handler)
+
+    def _get(self, userId, id, format='full', metadataHeaders=None):
+        def handler():
+            if id not in self.mailbox:
+                raise _http_error(404, 'Requested entity was not found.')
+            return self._payload(id, format, metadataHeaders)
+        return FakeRequest(self.backend, 'gmail.users.messages.get', handler)
+
+    def _history(self, userId, startHistoryId, historyTypes=None, labelId=None, maxResults=100, pageToken=None):
+        def handler():
+            with self.lock:
+                oldest = self.added[0][0] if self.added else self.history_id
+                if int(startHistoryId) < oldest - 1:
+                    raise _http_error(404, 'Requested entity was not found.')
+                added = [(history_id, message_id) for history_id, message_id, labels in self.added
+                         if history_id > int(startHistoryId) and (labelId is None or labelId in labels)]
+            start = int(pageToken or 0)
+            page = added[start:start + maxResults]
+            response = {'historyId': str(self.history_id)}
+            if page:
+                response['history'] = [{'id': str(history_id), 'messagesAdded': [{'message': {'id': message_id}}]}
+                                       for history_id, message_id in page]
+            if start + maxResults < len(added):
+                response['nextPageToken'] = str(start + maxResults)
+            return response
+        return FakeRequest(self.backend, 'gmail.users.history.list', handler)
+
+    def _create_draft(self, userId, body):
+        def handler():
+            with self.lock:
+                number = len(self.created_drafts) + 1
+                draft = {'id': f"r{number}", 'message': {'id': f"d{number}"}}
+                self.created_drafts.append((draft, body))
+            return draft
+        return FakeRequest(self.backend, 'gmail.users.drafts.create', handler)
+
+
+class FakeSheets:
+    """Spreadsheet kept in memory, served through the spreadsheets() surface we use.
+
+    Values are stored as written; formulas are kept as text and not evaluated. Like the real
+    API, writes outside a tab's grid fail (failing the whole batch) and only append grows it.
+    """
+
+    def __init__(self, backend, titles=("Sheet1",)):
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.tabs = {title: [] for title in titles}
+        self.sheet_ids = {title: index for index, title in enumerate(titles)}
+        self.grids = {title: [GRID_ROWS, GRID_COLUMNS] for title in titles}
+
+    def spreadsheets(self):
+        return _Resource(self, {'get': self._get_spreadsheet, 'batchUpdate': self._batch_update_spreadsheet,
+                                'values': lambda: _Resource(self, {
+                                    'get': self._get_values, 'batchGet': self._batch_get_values,
+                                    'update': self._update_values, 'append': self._append_values,
+                                    'batchUpdate': self._batch_update_values})})
+
+    def _parse_range(self, a1_range):
+        match = _RANGE.match(a1_range)
+        if not match or (match.group('title') or 'Sheet1') not in self.tabs:
+            raise _http_error(400, f"Unable to parse range: {a1_range}")
+        first_col = _column_index(match.group('c1'))
+        last_col = _column_index(match.group('c2') or match.group('c1'))
+        first_row = int(match.group('r1') or 1)
+        last_row = int(match.group('r2')) if match.group('r2') else None
+        return match.group('title') or 'Sheet1', first_row, last_row, first_col, last_col
+
+    def _read(self, a1_range, render):
+        title, first_row, last_row, first_col, last_col = self._parse_range(a1_range)
+        rows = self.tabs[title][first_row - 1:last_row]
+        values = []
+        for row in rows:
+            cells = row[first_col:last_col + 1]
+            cells = [cell if render == 'UNFORMATTED_VALUE' else ('' if cell is None else str(cell)) for cell in cells]
+            while cells and cells[-1] in ('', None):
+                cells.pop()
+            values.append(cells)
+        while values and not values[-1]:
+            values.pop()
+        response = {'range': a1_range, 'majorDimension': 'ROWS'}
+        if values:
+            response['values'] = values
+        return response
+
+    def _check_grid(self, a1_range, values):
+        title, first_row, _, first_col, _ = self._parse_range(a1_range)
+        max_rows, max_columns = self.grids[title]
+        last_row = first_row + len(values) - 1
+        last_col = first_col + max((len(row) for row in values), default=0)
+        if last_row > max_rows or last_col > max_columns:
+            raise _http_error(400, f"Range ({a1_range}) exceeds grid limits. "
+                                   f"Max rows: {max_rows}, max columns: {max_columns}")
+
+    def _write(self, a1_range, values):
+        title, first_row, _, first_col, _ = self._parse_range(a1_range)
+        rows = self.tabs[title]
+        for offset, new_row in enumerate(values):
+            while len(rows) < first_row + offset:
+                rows.append([])
+            row = rows[first_row + offset - 1]
+            while len(row) < first_col + len(new_row):
+                row.append(None)
+            row[first_col:first_col + len(new_row)] = new_row
+        return {'updatedRange': a1_range, 'updatedRows': len(values)}
+
+    def _get_spreadsheet(self, spreadsheetId, fields=None, **kwargs):
+        def handler():
+            with self.lock:
+                return {'sheets': [{'properties': {'title': title, 'sheetId': sheet_id, 'gridProperties': {
+                                    'rowCount': self.grids[title][0], 'columnCount': self.grids[title][1]}}}
+                                   for title, sheet_id in self.sheet_ids.items()]}
+        return FakeRequest(self.backend, 'sheets.spreadsheets.get', handler)
+
+    def _batch_update_spreadsheet(self, spreadsheetId, body):
+        def handler():
+            replies = []
+            with self.lock:
+                for request in body['requests']:
+                    if 'appendDimension' in request:
+                        append = request['appendDimension']
+                        titles = [title for title, sheet_id in self.sheet_ids.items() if sheet_id == append['sheetId']]
+                        if not titles:
+                            raise _http_error(400, f"No grid with id: {append['sheetId']}")
+                        self.grids[titles[0]][0 if append['dimension'] == 'ROWS' else 1] += append['length']
+                        replies.append({})
+                        continue
+                    properties = dict(request['addSheet']['properties'])
+                    if properties['title'] in self.tabs:
+                        raise _http_error(400, f"A sheet with the name \"{properties['title']}\" already exists.")
+                    properties.setdefault('sheetId', max(self.sheet_ids.values(), default=0) + 1)
+                    grid = properties.setdefault('gridProperties', {})
+                    grid.setdefault('rowCount', GRID_ROWS)
+                    grid.setdefault('columnCount', GRID_COLUMNS)
+                    self.tabs[properties['title']] = []
+                    self.sheet_ids[properties['title']] = properties['sheetId']
+                    self.grids[properties['title']] = [grid['rowCount'], grid['columnCount']]
+                    replies.append({'addSheet': {'properties': properties}})
+            return {'spreadsheetId': spreadsheetId, 'replies': replies}
+        return FakeRequest(self.backend, 'sheets.spreadsheets.batchUpdate', handler)
+
+    def _get_values(self, spreadsheetId, range, valueRenderOption='FORMATTED_VALUE', **kwargs):
+        def handler():
+            with self.lock:
+                return self._read(range, valueRenderOption)
+        return FakeRequest(self.backend, 'sheets.spreadsheets.values.get', handler)
+
+    def _batch_get_values(self, spreadsheetId, ranges, valueRenderOption='FORMATTED_VALUE', **kwargs):
+        def handler():
+            with self.lock:
+                return {'valueRanges': [self._read(a1_range, valueRenderOption) for a1_range in ranges]}
+        return FakeRequest(self.backend, 'sheets.spreadsheets.values.batchGet', handler)
+
+    def _update_values(self, spreadsheetId, range, valueInputOption, body):
+        def handler():
+            with self.lock:
+                self._check_grid(range, body['values'])
+                return self._write(range, body['values'])
+        return FakeRequest(self.backend, 'sheets.spreadsheets.values.update', handler)
+
+    def _append_values(self, spreadsheetId, range, valueInputOption, body):
+        def handler():
+            with self.lock:
+                title = self._parse_range(range)[0]
+                start = len(self.tabs[title]) + 1
+                # Appending inserts rows, so the grid grows to fit.
+                self.grids[title][0] = max(self.grids[title][0], start + len(body['values']) - 1)
+                return {'updates': self._write(f"{title}!A{start}", body['values'])}
+        return FakeRequest(self.backend, 'sheets.spreadsheets.values.append', handler)
+
+    def _batch_update_values(self, spreadsheetId, body):
+        def handler():
+            with self.lock:
+                # Checked up front: one out-of-grid range fails the whole batch.
+                for data in body['data']:
+                    self._check_grid(data['range'], data['values'])
+                responses = [self._write(data['range'], data['values']) for data in body['data']]
+            return {'totalUpdatedRows': sum(response['updatedRows'] for response in responses)}
+        return FakeRequest(self.backend, 'sheets.spreadsheets.values.batchUpdate', handler)
+
+
+class _Resource:
+    def __init__(self, owner, methods):
+        self.owner = owner
+        self.methods = methods
+
+    def __getattr__(self, name):
+        try:
+            return self.methods[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def new_batch_http_request(self, callback=None):
+        return self.owner.new_batch_http_request(callback)
+
+
+def _column_index(letters):
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - ord('A') + 1
+    return index - 1
+
+
+class FakeProvider:
+    """Drop-in for google_clients.CredentialsProvider that hands out the fake services."""
+
+    def __init__(self, gmail, sheets):
+        self.services = {('gmail', 'v1'): gmail, ('sheets', 'v4'): sheets}
+
+    def get_credentials(self):
+        return None
+
+    def service(self, name, version):
+        return self.services[(name, version)]
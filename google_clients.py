@@ -0,0 +1,141 @@
+import os
+import threading
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+
+import requests
+from google.auth.transport.requests import AuthorizedSession, Request
+from google.oauth2.credentials import Credentials
+
+from instrumentation import metrics
+
+# googleapiclient's discovery machinery and the OAuth consent flow are slow to import and
+# not needed for a token refresh or a raw API call, so they are imported where they are used.
+
+# If modifying these scopes, delete the file token.json.
+SCOPES = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/gmail.readonly']
+TOKEN_FILE = 'token.json'
+CLIENT_SECRETS_FILE = 'credentials.json'
+# Refresh a bit before Google's own expiry check would, so no call waits on a refresh.
+REFRESH_MARGIN = timedelta(minutes=5)
+# Connections kept alive per host, and (connect, read) timeouts in seconds.
+POOL_SIZE = 10
+TIMEOUT = (10, 60)
+
+_discovery_documents = {}
+_discovery_lock = threading.Lock()
+
+
+def get_discovery_document(name, version):
+    """Return the discovery document bundled with googleapiclient, read once per process."""
+    from googleapiclient.discovery_cache import get_static_doc
+    with _discovery_lock:
+        if (name, version) not in _discovery_documents:
+            document = get_static_doc(name, version)
+            if document is None:
+                raise ValueError(f"No bundled discovery document for {name} {version}")
+            _discovery_documents[(name, version)] = document
+        return _discovery_documents[(name, version)]
+
+
+class _Response(dict):
+    # The parts of httplib2.Response that googleapiclient reads: lower-cased headers, status and reason.
+    def __init__(self, response):
+        super().__init__((key.lower(), value) for key, value in response.headers.items())
+        self['status'] = str(response.status_code)
+        self.status = response.status_code
+        self.reason = response.reason
+
+
+class SessionHttp:
+    """httplib2-style transport over a pooled keep-alive requests session that threads can share."""
+
+    def __init__(self, credentials, pool_size=POOL_SIZE, timeout=TIMEOUT):
+        # googleapiclient's batch requests read `credentials` to authorize the calls inside a batch.
+        self.credentials = credentials
+        self.timeout = timeout
+        self.session = AuthorizedSession(credentials)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=5, connection_type=None):
+        response = self.session.request(method, uri, data=body, headers=headers, timeout=self.timeout,
+                                        allow_redirects=redirections > 0)
+        # Counted per API host: gmail.googleapis.com, sheets.googleapis.com, oauth2...
+        metrics.add_bytes(urlsplit(uri).hostname.split('.')[0], len(body or b''), len(response.content))
+        return _Response(response), response.content
+
+    def close(self):
+        self.session.close()
+
+
+class CredentialsProvider:
+    """Loads, refreshes and caches the OAuth credentials stored in one token file.
+
+    Service objects built from the same provider are cached and share one transport,
+    created by `http_factory(credentials)`: a pooled SessionHttp unless told otherwise.
+    """
+
+    def __init__(self, token_path=TOKEN_FILE, client_secrets_path=CLIENT_SECRETS_FILE, scopes=SCOPES,
+                 http_factory=SessionHttp):
+        self.token_path = token_path
+        self.client_secrets_path = client_secrets_path
+        self.scopes = scopes
+        self.http_factory = http_factory
+        self.creds = None
+        self.http = None
+        self.services = {}
+        self.lock = threading.RLock()
+
+    def get_credentials(self):
+        with self.lock:
+            if self.creds is None and os.path.exists(self.token_path):
+                self.creds = Credentials.from_authorized_user_file(self.token_path, self.scopes)
+            if self.creds is None or not (self.creds.valid or self.creds.refresh_token):
+                from google_auth_oauthlib.flow import InstalledAppFlow
+                flow = InstalledAppFlow.from_client_secrets_file(self.client_secrets_path, self.scopes)
+                self.creds = flow.run_local_server(port=0)
+                self._save()
+            elif self._expires_soon():
+                self.creds.refresh(Request())
+                self._save()
+            return self.creds
+
+    def _expires_soon(self):
+        if not self.creds.valid:
+            return True
+        # google-auth keeps expiry as a naive UTC datetime.
+        return self.creds.expiry is not None and self.creds.expiry - REFRESH_MARGIN <= datetime.utcnow()
+
+    def _save(self):
+        tmp_path = f"{self.token_path}.tmp"
+        with open(tmp_path, 'w') as token:
+            token.write(self.creds.to_json())
+        os.replace(tmp_path, self.token_path)
+
+    def transport(self):
+        """The shared authorized transport, also usable for raw requests before any service is built."""
+        with self.lock:
+            creds = self.get_credentials()
+            if self.http is None:
+                self.http = self.http_factory(creds)
+            return self.http
+
+    def service(self, name, version):
+        from googleapiclient.discovery import build_from_document
+        with self.lock:
+            http = self.transport()
+            if (name, version) not in self.services:
+                self.services[(name, version)] = build_from_document(get_discovery_document(name, version), http=http)
+            return self.services[(name, version)]
+
+
+_default_provider = None
+
+
+def default_provider():
+    """The process-wide provider for token.json, shared by every manager that is not given its own."""
+    global _default_provider
+    if _default_provider is None:
+        _default_provider = CredentialsProvider()
+    return _default_provider
@@ -0,0 +1,163 @@
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    from opentelemetry import trace
+except ImportError:  # OpenTelemetry is optional; without it we only keep local metrics.
+    trace = None
+
+# Upper bounds, in seconds, of the latency histogram buckets (Prometheus' defaults).
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def to_dict(self):
+        return {'count': self.count, 'sum': round(self.sum, 6), 'max': round(self.max, 6),
+                'mean': round(self.sum / self.count, 6) if self.count else None,
+                'buckets': {str(bound): count for bound, count in zip(self.buckets + ('+Inf',), self.counts)}}
+
+
+class Metrics:
+    """Thread-safe stage timings, API call latencies, bytes transferred and item counts for one run.
+
+    Recorded in the process that does the work: stages run in parse worker
+    processes are only visible through the time the parent spends waiting on them.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tracer = None
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.stages = {}
+            self.calls = {}
+            self.errors = Counter()
+            self.items = Counter()
+            self.bytes_sent = Counter()
+            self.bytes_received = Counter()
+
+    def enable_tracing(self, name='vinted_sync'):
+        """Also emit an OpenTelemetry span per stage and API call, to whatever exporter is configured."""
+        if trace is None:
+            raise RuntimeError("opentelemetry-api is not installed")
+        self.tracer = trace.get_tracer(name)
+
+    @contextmanager
+    def _span(self, name, **attributes):
+        if self.tracer is None:
+            yield
+            return
+        with self.tracer.start_as_current_span(name, attributes=attributes):
+            yield
+
+    @contextmanager
+    def stage(self, name):
+        """Time the block as one run of stage `name`."""
+        start = time.perf_counter()
+        try:
+            with self._span(name):
+                yield
+        finally:
+            self._observe(self.stages, name, time.perf_counter() - start)
+
+    @contextmanager
+    def call(self, endpoint):
+        """Time the block as one API call to `endpoint`, counting the errors it raises."""
+        start = time.perf_counter()
+        try:
+            with self._span(endpoint, endpoint=endpoint):
+                yield
+        except Exception:
+            with self.lock:
+                self.errors[endpoint] += 1
+            raise
+        finally:
+            self._observe(self.calls, endpoint, time.perf_counter() - start)
+
+    def _observe(self, histograms, name, seconds):
+        with self.lock:
+            histograms.setdefault(name, Histogram()).observe(seconds)
+
+    def add_items(self, stage, count):
+        with self.lock:
+            self.items[stage] += count
+
+    def add_bytes(self, api, sent, received):
+        with self.lock:
+            self.bytes_sent[api] += sent
+            self.bytes_received[api] += received
+
+    def report(self, **extra):
+        """The run report as a JSON-serialisable dict; `extra` is merged in at the top level."""
+        with self.lock:
+            report = {
+                'started': datetime.fromtimestamp(self.started).isoformat(),
+                'wall_seconds': round(time.time() - self.started, 3),
+                'stages': {name: dict(histogram.to_dict(), items=self.items.get(name, 0))
+                           for name, histogram in self.stages.items()},
+                'api_calls': {name: dict(histogram.to_dict(), errors=self.errors.get(name, 0))
+                              for name, histogram in self.calls.items()},
+                'bytes_sent': dict(self.bytes_sent),
+                'bytes_received': dict(self.bytes_received),
+            }
+        report.update(extra)
+        return report
+
+    def write_report(self, path, **extra):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as report_file:
+            json.dump(self.report(**extra), report_file, indent=2)
+        os.replace(tmp_path, path)
+
+    def prometheus(self):
+        """The same metrics in the Prometheus text exposition format, e.g. for node_exporter's textfile collector."""
+        lines = []
+        with self.lock:
+            for metric, label, histograms in (('vinted_sync_stage_seconds', 'stage', self.stages),
+                                              ('vinted_sync_api_call_seconds', 'endpoint', self.calls)):
+                lines += [f"# TYPE {metric} histogram"]
+                for name, histogram in sorted(histograms.items()):
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                        cumulative += count
+                        lines.append(f'{metric}_bucket{{{label}="{name}",le="{bound}"}} {cumulative}')
+                    lines.append(f'{metric}_sum{{{label}="{name}"}} {histogram.sum}')
+                    lines.append(f'{metric}_count{{{label}="{name}"}} {histogram.count}')
+            for metric, label, counter in (('vinted_sync_items_total', 'stage', self.items),
+                                           ('vinted_sync_api_errors_total', 'endpoint', self.errors),
+                                           ('vinted_sync_bytes_sent_total', 'api', self.bytes_sent),
+                                           ('vinted_sync_bytes_received_total', 'api', self.bytes_received)):
+                lines.append(f"# TYPE {metric} counter")
+                lines += [f'{metric}{{{label}="{name}"}} {value}' for name, value in sorted(counter.items())]
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as metrics_file:
+            metrics_file.write(self.prometheus())
+        os.replace(tmp_path, path)
+
+
+metrics = Metrics()
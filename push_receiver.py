@@ -0,0 +1,191 @@
+import argparse
+import asyncio
+import base64
+import json
+import queue
+import signal
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from api_calls import execute
+from async_pipeline import run_sync
+from email_cache import EmailCache
+from refactored_process import GmailManager, GoogleSheets
+from sale_index import SaleIndex
+from sales_store import SalesStore
+from sync_state import SyncState
+
+try:
+    from google.cloud import pubsub_v1
+except ImportError:  # google-cloud-pubsub is only needed to pull notifications instead of receiving pushes.
+    pubsub_v1 = None
+
+PORT = 8080
+# Google asks for watch() to be renewed at least every 7 days and recommends daily.
+RENEW_INTERVAL = 24 * 3600
+RENEW_MARGIN = 3600
+# Pub/Sub delivery is not guaranteed, so an incremental sync also runs after this much silence.
+FALLBACK_INTERVAL = 3600
+
+
+class PushHandler(BaseHTTPRequestHandler):
+    """Accepts Pub/Sub push deliveries of Gmail notifications and queues them.
+
+    The push endpoint URL must carry ?token=<secret> matching the server's token.
+    """
+
+    def do_POST(self):
+        token = parse_qs(urlsplit(self.path).query).get('token', [None])[0]
+        if self.server.token and token != self.server.token:
+            self.send_response(403)
+            self.end_headers()
+            return
+        try:
+            envelope = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            notification = json.loads(base64.b64decode(envelope['message']['data']))
+            int(notification['historyId'])
+        except (ValueError, KeyError, TypeError):
+            self.send_response(400)
+            self.end_headers()
+            return
+        self.server.notifications.put(notification)
+        # Any 2xx acknowledges the message; anything else makes Pub/Sub redeliver it.
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_push(notifications, port=PORT, token=None):
+    """Start the push endpoint on a background thread and return the server."""
+    server = ThreadingHTTPServer(('', port), PushHandler)
+    server.notifications = notifications
+    server.token = token
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def pull_notifications(notifications, subscription):
+    """Feed `notifications` from a Pub/Sub pull subscription instead of push deliveries."""
+    if pubsub_v1 is None:
+        raise RuntimeError("google-cloud-pubsub is not installed")
+
+    def callback(message):
+        notifications.put(json.loads(message.data))
+        message.ack()
+
+    return pubsub_v1.SubscriberClient().subscribe(subscription, callback=callback)
+
+
+class PushReceiver:
+    """Keeps a Gmail watch() alive and syncs the history behind each notification it receives.
+
+    `notifications` is any queue.Queue-like object that receives the decoded
+    {"emailAddress", "historyId"} notifications: from serve_push, pull_notifications, or a
+    test putting them there directly. Notifications that arrive together are coalesced into
+    one incremental sync from the stored historyId.
+    """
+
+    def __init__(self, gmail_manager, sheets_manager, state, sale_index, topic, notifications=None,
+                 email_cache=None, sales_store=None):
+        self.gmail_manager = gmail_manager
+        self.sheets_manager = sheets_manager
+        self.state = state
+        self.sale_index = sale_index
+        self.email_cache = email_cache
+        self.sales_store = sales_store
+        self.topic = topic
+        self.notifications = notifications if notifications is not None else queue.Queue()
+        self.expiration = None
+        self.stopping = threading.Event()
+
+    def watch(self):
+        # No labelIds: a sale that a filter skips the inbox for still has to trigger a sync.
+        response = execute(self.gmail_manager.service.users().watch(userId='me', body={'topicName': self.topic}),
+                           self.gmail_manager.limiter)
+        self.expiration = int(response['expiration']) / 1000
+        return response
+
+    def renew_watch(self):
+        while not self.stopping.wait(max(60, min(RENEW_INTERVAL, self.expiration - RENEW_MARGIN - time.time()))):
+            try:
+                self.watch()
+            except Exception as error:
+                # Retried on the next wake-up; the watch is still valid until its expiration.
+                print(f"Renewing the Gmail watch failed: {error}")
+
+    def sync(self):
+        # Rows may have been added to the sheet by hand since the last sync; the row counts get re-checked.
+        self.sheets_manager.refresh_metadata()
+        return asyncio.run(run_sync(self.gmail_manager, self.sheets_manager, self.state, self.sale_index,
+                                    email_cache=self.email_cache, sales_store=self.sales_store))
+
+    def try_sync(self):
+        """Sync, reporting any failure instead of raising it, so the receiver keeps running."""
+        try:
+            return self.sync()
+        except Exception as error:
+            # The checkpoint did not move, so the next notification retries the same history.
+            print(f"Sync failed: {error}")
+            return None
+
+    def next_history_id(self, timeout):
+        """Wait for notifications and return the newest historyId among them, or None on timeout."""
+        try:
+            history_ids = [int(self.notifications.get(timeout=timeout)['historyId'])]
+        except queue.Empty:
+            return None
+        while True:
+            try:
+                history_ids.append(int(self.notifications.get_nowait()['historyId']))
+            except queue.Empty:
+                return max(history_ids)
+
+    def process(self, fallback_interval=FALLBACK_INTERVAL):
+        while True:
+            history_id = self.next_history_id(fallback_interval)
+            if self.stopping.is_set():
+                break
+            # Notifications are sent for every mailbox change; ones we have already synced past are skipped.
+            if history_id is not None and self.state.history_id and history_id <= int(self.state.history_id):
+                continue
+            self.try_sync()
+
+    def run(self, fallback_interval=FALLBACK_INTERVAL):
+        """Watch the mailbox, catch up on anything missed while we were down, then process notifications."""
+        self.watch()
+        self.try_sync()
+        threading.Thread(target=self.renew_watch, daemon=True).start()
+        self.process(fallback_interval)
+
+    def stop(self, *args):
+        self.stopping.set()
+        # Wake process() up if it is waiting on the queue.
+        self.notifications.put({'historyId': 0})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sync sale emails as Gmail push notifications arrive.")
+    parser.add_argument('--topic', required=True, help="Pub/Sub topic Gmail publishes to, projects/<p>/topics/<t>")
+    parser.add_argument('--port', type=int, default=PORT, help="port of the push endpoint")
+    parser.add_argument('--token', help="secret expected as ?token= on push deliveries")
+    parser.add_argument('--subscription', help="pull from this Pub/Sub subscription instead of serving pushes")
+    parser.add_argument('--fallback-interval', type=float, default=FALLBACK_INTERVAL,
+                        help="seconds without notifications after which we sync anyway")
+    args = parser.parse_args()
+
+    receiver = PushReceiver(GmailManager(), GoogleSheets(), SyncState(), SaleIndex(), args.topic,
+                            email_cache=EmailCache(), sales_store=SalesStore())
+    if args.subscription:
+        pull_notifications(receiver.notifications, args.subscription)
+    else:
+        serve_push(receiver.notifications, args.port, args.token)
+    signal.signal(signal.SIGINT, receiver.stop)
+    signal.signal(signal.SIGTERM, receiver.stop)
+    try:
+        receiver.run(args.fallback_interval)
+    finally:
+        execute(receiver.gmail_manager.service.users().stop(userId='me'), receiver.gmail_manager.limiter)
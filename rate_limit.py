@@ -0,0 +1,86 @@
+import threading
+import time
+
+# Gmail allows 250 quota units per user per second; each method has its own cost.
+GMAIL_UNITS_PER_SECOND = 250
+MESSAGE_GET_UNITS = 5
+GMAIL_METHOD_UNITS = {
+    'gmail.users.getProfile': 1,
+    'gmail.users.history.list': 2,
+    'gmail.users.messages.list': 5,
+    'gmail.users.messages.get': MESSAGE_GET_UNITS,
+    'gmail.users.drafts.create': 10,
+    'gmail.users.stop': 50,
+    'gmail.users.watch': 100,
+}
+# Sheets allows 60 requests per user per minute.
+SHEETS_REQUESTS_PER_MINUTE = 60
+# Limits for the whole Cloud project, shared by every account it syncs.
+GMAIL_PROJECT_UNITS_PER_SECOND = 20000
+SHEETS_PROJECT_REQUESTS_PER_MINUTE = 300
+
+
+class TokenBucket:
+    """Thread-safe token bucket refilled with `rate` tokens per second, holding at most `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, tokens=1):
+        """Take `tokens` now and return how many seconds the caller has to wait before spending them.
+
+        A batch costing more than `capacity` leaves the bucket in debt, so its cost is paid
+        over as many refills as it needs and later callers wait for the rest.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= tokens
+            return max(0.0, -self.tokens / self.rate)
+
+    def acquire(self, tokens=1):
+        delay = self.reserve(tokens)
+        if delay:
+            time.sleep(delay)
+        return delay
+
+
+class AdaptiveTokenBucket(TokenBucket):
+    """Token bucket that halves its rate when the API pushes back and creeps back up on success."""
+
+    def __init__(self, rate, capacity=None, min_rate=None):
+        super().__init__(rate, capacity)
+        self.max_rate = rate
+        self.min_rate = min_rate or rate / 32
+
+    def throttle(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def recover(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 50)
+
+
+def gmail_quota(units_per_second=GMAIL_UNITS_PER_SECOND):
+    return AdaptiveTokenBucket(units_per_second)
+
+
+def sheets_quota(requests_per_minute=SHEETS_REQUESTS_PER_MINUTE):
+    return AdaptiveTokenBucket(requests_per_minute / 60, capacity=requests_per_minute)
+
+
+def fair_share(accounts):
+    """Per-account (Gmail units per second, Sheets requests per minute) when `accounts` share one project."""
+    return (min(GMAIL_UNITS_PER_SECOND, GMAIL_PROJECT_UNITS_PER_SECOND / accounts),
+            min(SHEETS_REQUESTS_PER_MINUTE, SHEETS_PROJECT_REQUESTS_PER_MINUTE / accounts))
+
+
+# Shared by every client in the process that is not given a budget of its own.
+GMAIL_LIMITER = gmail_quota()
+SHEETS_LIMITER = sheets_quota()
@@ -1,185 +1,530 @@
-import os.path
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+import argparse
+import asyncio
+import re
 from googleapiclient.errors import HttpError
-import base64
-from bs4 import BeautifulSoup
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
+from itertools import islice
+from api_calls import MAX_RETRIES, backoff, execute, is_transient, stats
+from async_pipeline import FLUSH_SIZE, run_sync
+from email_cache import EmailCache
+from email_parsing import (extract_item_and_price, get_message_body, get_message_html, get_message_subject,
+                           is_sale_message, parse_sale)
+from google_clients import default_provider
+from instrumentation import metrics
+from rate_limit import GMAIL_LIMITER, MESSAGE_GET_UNITS, SHEETS_LIMITER
+from sale_index import SaleIndex
+from sales_store import SalesStore
+from sync_state import SyncState
 
-SCOPES = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/gmail.readonly']
 SPREADSHEET_ID = '1oBMj-n4iRuDqGmbKpBeB3P_qL4ucAIhr-phU40gsRRA'
 SHEET_RANGE = 'Sheet1!C:D'
-CURRENT_DATE = datetime.now().strftime("%Y-%m-%d")
+
+# Gmail accepts at most 100 calls per batch request but starts rate limiting
+# large batches, so we default to 50 and run a few batches side by side.
+MAX_BATCH_SIZE = 100
+BATCH_SIZE = 50
+MAX_WORKERS = 4
+# Worker processes used to decode and parse emails; 0 parses in the main process.
+PARSE_WORKERS = 0
+# messages().list returns at most 500 IDs per page.
+PAGE_SIZE = 500
+# Sheet1 gets a Total row once it holds this many rows; later sales go to Sheet_<date>.
+# With a SalesStore doing the reporting, rows_per_sheet=None keeps every sale on one tab.
+ROWS_PER_SHEET = 50
+# read_sales() pages through each sheet this many rows at a time.
+READ_CHUNK_ROWS = 5000
+RUN_REPORT_FILE = 'run_report.json'
+
+# Gmail's subject: operator matches words rather than the exact subject, so
+# the query narrows the listing and iter_sale_messages checks the exact title.
+SALE_SUBJECT = "This order is completed"
+SALE_SENDER = "@vinted.nl"
+DEFAULT_QUERY = f'from:{SALE_SENDER} subject:"{SALE_SUBJECT}"'
+_QUERY_SENDER = re.compile(r'(?:^|\s)from:"?([^"\s]+)"?', re.I)
+
+
+def query_sender(query):
+    """The from: part of a Gmail search query, so messages found without the query can be checked against it."""
+    match = _QUERY_SENDER.search(query or '')
+    return match.group(1) if match else None
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def iter_message_ids(service, query, max_results=PAGE_SIZE, limiter=GMAIL_LIMITER):
+    """Yield the ID of every message matching `query`, fetching pages lazily."""
+    page_token = None
+    while True:
+        results = execute(service.users().messages().list(
+            userId='me', q=query, maxResults=max_results, pageToken=page_token), limiter)
+        for message in results.get('messages', []):
+            yield message['id']
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return
+
+
+def list_history(service, start_history_id, max_results=PAGE_SIZE, limiter=GMAIL_LIMITER):
+    """Return the mailbox's current historyId and a generator over IDs of messages added since `start_history_id`.
+
+    Every label is listed, so sales a filter archived are not missed; the sender and subject
+    checks leave out drafts and sent mail. History still lists messages that were deleted
+    afterwards; fetching those returns 404.
+    """
+    def fetch_page(page_token=None):
+        return execute(service.users().history().list(
+            userId='me', startHistoryId=start_history_id, historyTypes=['messageAdded'],
+            maxResults=max_results, pageToken=page_token), limiter)
+
+    def message_ids(results):
+        while True:
+            for record in results.get('history', []):
+                for added in record.get('messagesAdded', []):
+                    yield added['message']['id']
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                return
+            results = fetch_page(page_token)
+
+    first_page = fetch_page()
+    return first_page['historyId'], message_ids(first_page)
+
+
+def _execute_message_batch(service, message_ids, positions, format, metadata_headers, results, limiter):
+    attempt = 0
+    while True:
+        errors = {}
+
+        def callback(request_id, response, exception):
+            if exception is None:
+                results[int(request_id)] = response
+            elif not (isinstance(exception, HttpError) and exception.resp.status == 404):
+                errors[int(request_id)] = exception
+            # A 404 means the message was deleted since it was listed; its result stays None.
+
+        batch = service.new_batch_http_request(callback=callback)
+        for position in positions:
+            batch.add(service.users().messages().get(userId='me', id=message_ids[position], format=format,
+                                                     metadataHeaders=metadata_headers),
+                      request_id=str(position))
+        # The service's pooled transport is thread-safe, so concurrent batches share its connections.
+        execute(batch, limiter, cost=len(positions) * MESSAGE_GET_UNITS)
+        if not errors:
+            return
+        for error in errors.values():
+            if not is_transient(error) or attempt >= MAX_RETRIES:
+                raise error
+        # Calls inside a batch fail one by one (mostly 429s), so only those are sent again.
+        backoff(error, attempt, limiter, 'gmail.users.messages.get')
+        positions = sorted(errors)
+        attempt += 1
+
+
+def batch_get_messages(service, message_ids, batch_size=BATCH_SIZE, max_workers=MAX_WORKERS, format='full',
+                       metadata_headers=None, limiter=GMAIL_LIMITER):
+    """Fetch messages with Gmail batch requests, returned in the same order as `message_ids`.
+
+    Messages deleted since they were listed are left out.
+    """
+    if not 0 < batch_size <= MAX_BATCH_SIZE:
+        raise ValueError(f"batch_size must be between 1 and {MAX_BATCH_SIZE}")
+    message_ids = list(message_ids)
+    results = [None] * len(message_ids)
+    chunks = [range(start, min(start + batch_size, len(message_ids)))
+              for start in range(0, len(message_ids), batch_size)]
+    stage = 'fetch' if format == 'full' else f'fetch_{format}'
+    with metrics.stage(stage), ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_execute_message_batch, service, message_ids, chunk, format,
+                                   metadata_headers, results, limiter)
+                   for chunk in chunks]
+        for future in futures:
+            future.result()
+    results = [msg for msg in results if msg is not None]
+    metrics.add_items(stage, len(results))
+    return results
+
+
+def iter_messages(service, message_ids, batch_size=BATCH_SIZE, max_workers=MAX_WORKERS, format='full',
+                  metadata_headers=None, limiter=GMAIL_LIMITER):
+    """Stream messages for an iterable of IDs, fetching one window of concurrent batches at a time."""
+    for window in chunked(message_ids, batch_size * max_workers):
+        yield from batch_get_messages(service, window, batch_size, max_workers, format, metadata_headers, limiter)
+
+
+def iter_sale_messages(service, message_ids, sale_subject=SALE_SUBJECT, batch_size=BATCH_SIZE,
+                       max_workers=MAX_WORKERS, limiter=GMAIL_LIMITER, sale_sender=SALE_SENDER):
+    """Fetch only the Subject and From headers first and download full payloads just for sale confirmations."""
+    headers = iter_messages(service, message_ids, batch_size, max_workers,
+                            format='metadata', metadata_headers=['Subject', 'From'], limiter=limiter)
+    sale_ids = (msg['id'] for msg in headers if is_sale_message(msg, sale_subject, sale_sender))
+    return iter_messages(service, sale_ids, batch_size, max_workers, format='full', limiter=limiter)
+
+
+def iter_parsed_sales(messages, workers=PARSE_WORKERS):
+    """Parse sale emails in a process pool, yielding records in the same order as `messages`."""
+    if workers <= 0:
+        yield from map(parse_sale, messages)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # A bounded window keeps fetching, parsing and writing overlapped without buffering the mailbox.
+        pending = deque()
+        for msg in messages:
+            pending.append(executor.submit(parse_sale, msg))
+            if len(pending) >= workers * 4:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
 
 
 ### Class 1: GmailManager
 
 class GmailManager:
-    def __init__(self):
+    def __init__(self, query=DEFAULT_QUERY, sale_subject=SALE_SUBJECT, batch_size=BATCH_SIZE,
+                 max_workers=MAX_WORKERS, credentials_provider=None, limiter=GMAIL_LIMITER):
+        self.credentials_provider = credentials_provider or default_provider()
+        self.limiter = limiter
         self.creds = None
+        self.query = query
+        self.sale_subject = sale_subject
+        # Incremental syncs do not run the query, so its sender filter is applied to their headers instead.
+        self.sale_sender = query_sender(query)
+        self.batch_size = batch_size
+        self.max_workers = max_workers
         self.service = self.authenticate_gmail_api()
 
     def authenticate_gmail_api(self):
-        if os.path.exists('token.json'):
-            self.creds = Credentials.from_authorized_user_file('token.json', SCOPES)
-        if not self.creds or not self.creds.valid:
-            if self.creds and self.creds.expired and self.creds.refresh_token:
-                self.creds.refresh(Request())
-            else:
-                flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
-                self.creds = flow.run_local_server(port=0)
-            with open('token.json', 'w') as token:
-                token.write(self.creds.to_json())
-        return build("gmail", "v1", credentials=self.creds)
-
-    def fetch_emails(self, query='from:@vinted.nl'):
-        try:
-            results = self.service.users().messages().list(userId="me", q=query).execute()
-            return results.get("messages", [])
-        except HttpError as error:
-            print(f"An error occurred: {error}")
-            return []
+        self.creds = self.credentials_provider.get_credentials()
+        return self.credentials_provider.service('gmail', 'v1')
+
+    def fetch_emails(self, query=None, max_results=PAGE_SIZE):
+        return iter_message_ids(self.service, query or self.query, max_results, self.limiter)
+
+    def changed_message_ids(self, state, full_resync=False):
+        """Return the historyId to checkpoint and the IDs to process, incrementally when `state` allows it."""
+        if state.history_id and not full_resync:
+            try:
+                return list_history(self.service, state.history_id, limiter=self.limiter)
+            except HttpError as error:
+                # Gmail only keeps about a week of history; older checkpoints return 404.
+                if error.resp.status != 404:
+                    raise
+                print("Stored historyId has expired, falling back to a full sync.")
+        # Read the historyId before listing so nothing that arrives mid-listing is skipped next run.
+        history_id = execute(self.service.users().getProfile(userId='me'), self.limiter)['historyId']
+        return history_id, self.fetch_emails()
+
+    def fetch_messages(self, message_ids, format='full', metadata_headers=None):
+        return batch_get_messages(self.service, message_ids, batch_size=self.batch_size,
+                                  max_workers=self.max_workers, format=format, metadata_headers=metadata_headers,
+                                  limiter=self.limiter)
+
+    def iter_messages(self, message_ids, format='full', metadata_headers=None):
+        return iter_messages(self.service, message_ids, batch_size=self.batch_size,
+                             max_workers=self.max_workers, format=format, metadata_headers=metadata_headers,
+                             limiter=self.limiter)
+
+    def iter_sale_messages(self, message_ids):
+        return iter_sale_messages(self.service, message_ids, sale_subject=self.sale_subject,
+                                  batch_size=self.batch_size, max_workers=self.max_workers, limiter=self.limiter,
+                                  sale_sender=self.sale_sender)
 
     def get_message_subject(self, msg):
-        for header in msg['payload']['headers']:
-            if header['name'] == 'Subject':
-                return header['value']
-        return "No Subject"
+        return get_message_subject(msg)
 
     def get_message_body(self, msg):
-        if 'parts' in msg['payload']:
-            for part in msg['payload']['parts']:
-                if part['mimeType'] == 'text/plain':
-                    return base64.urlsafe_b64decode(part['body']['data']).decode('utf-8')
-                elif part['mimeType'] == 'text/html':
-                    html_body = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8')
-                    soup = BeautifulSoup(html_body, 'html.parser')
-                    return soup.get_text()
-        else:
-            return base64.urlsafe_b64decode(msg['payload']['body']['data']).decode('utf-8')
-        return None
+        return get_message_body(msg)
+
+    def get_message_html(self, msg):
+        return get_message_html(msg)
 
     def extract_item_and_price(self, html_body):
-        soup = BeautifulSoup(html_body, 'html.parser')
-        item_name = ""
-        sale_info = soup.find_all('p')
-        for p_tag in sale_info:
-            if "Your sale of" in p_tag.get_text():
-                item_name_span = p_tag.find('span')
-                if item_name_span:
-                    item_name = item_name_span.get_text(strip=True).split("was completed")[0].strip()
-                break
-        price_info = soup.find('td', string='Item price:')
-        price = price_info.find_next('td').get_text(strip=True) if price_info else ""
-        return item_name, price
+        return extract_item_and_price(html_body)
 
 
 ### Class 2: SheetsManager
 
 class GoogleSheets:
-    def __init__(self):
+    def __init__(self, credentials_provider=None, limiter=SHEETS_LIMITER, spreadsheet_id=SPREADSHEET_ID,
+                 rows_per_sheet=ROWS_PER_SHEET):
+        self.credentials_provider = credentials_provider or default_provider()
+        self.spreadsheet_id = spreadsheet_id
+        self.rows_per_sheet = rows_per_sheet
+        self.limiter = limiter
         self.creds = None
+        self.pending_items = []
+        self.row_hints = {}
+        self.refresh_metadata()
         self.service = self.authenticate_sheets_api()
 
     def authenticate_sheets_api(self):
-        if os.path.exists('token.json'):
-            self.creds = Credentials.from_authorized_user_file('token.json', SCOPES)
-        if not self.creds or not self.creds.valid:
-            if self.creds and self.creds.expired and self.creds.refresh_token:
-                self.creds.refresh(Request())
-            else:
-                flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
-                self.creds = flow.run_local_server(port=0)
-            with open('token.json', 'w') as token:
-                token.write(self.creds.to_json())
-        return build('sheets', 'v4', credentials=self.creds)
+        self.creds = self.credentials_provider.get_credentials()
+        return self.credentials_provider.service('sheets', 'v4')
+
+    def refresh_metadata(self):
+        """Forget cached sheet IDs, row counts and Total rows so the next lookups re-read them."""
+        self.sheet_ids = None
+        self.grid_rows = {}
+        self.row_counts = {}
+        self.total_rows = {}
 
     def check_if_total_exists(self, sheet_title, current_row_count):
-        result = self.service.spreadsheets().values().get(
-            spreadsheetId=SPREADSHEET_ID,
-            range=f"{sheet_title}!C{current_row_count-1}:C{current_row_count}"
-        ).execute()
-        values = result.get('values', [])
-        return any("Total" in row[0] for row in values if row)
+        if sheet_title not in self.total_rows:
+            result = execute(self.service.spreadsheets().values().get(
+                spreadsheetId=self.spreadsheet_id,
+                range=f"{sheet_title}!C{current_row_count-1}:C{current_row_count}"
+            ), self.limiter)
+            values = result.get('values', [])
+            self.total_rows[sheet_title] = any("Total" in row[0] for row in values if row)
+        return self.total_rows[sheet_title]
 
-    def get_next_empty_row(self, sheet_title):
-        result = self.service.spreadsheets().values().get(
-            spreadsheetId=SPREADSHEET_ID, 
+    def get_sheet_titles(self):
+        if self.sheet_ids is None:
+            spreadsheet = execute(self.service.spreadsheets().get(
+                spreadsheetId=self.spreadsheet_id, fields='sheets.properties(sheetId,title,gridProperties.rowCount)'
+            ), self.limiter)
+            self.sheet_ids = {sheet['properties']['title']: sheet['properties']['sheetId']
+                              for sheet in spreadsheet.get('sheets', [])}
+            self.grid_rows = {sheet['properties']['title']: sheet['properties']['gridProperties']['rowCount']
+                              for sheet in spreadsheet.get('sheets', [])}
+        return list(self.sheet_ids)
+
+    def get_sheet_by_title(self, sheet_title):
+        self.get_sheet_titles()
+        return self.sheet_ids.get(sheet_title)
+
+    def read_rows(self, sheet_title):
+        result = execute(self.service.spreadsheets().values().get(
+            spreadsheetId=self.spreadsheet_id,
             range=f"{sheet_title}!A:E"
-        ).execute()
-        values = result.get('values', [])
-        return len(values) + 1
-
-    def append_new_items_in_decreasing_order(self, sheet_title, new_items):
-        result = self.service.spreadsheets().values().get(
-            spreadsheetId=SPREADSHEET_ID, range=f"{sheet_title}!C:C").execute()
-        existing_items = [row[0] for row in result.get('values', []) if row]
-        missing_items = [item for item in new_items if item['name'] not in existing_items]
-        if not missing_items:
+        ), self.limiter)
+        rows = result.get('values', [])
+        self.row_counts[sheet_title] = len(rows)
+        self.total_rows[sheet_title] = any("Total" in row[2] for row in rows[-2:] if len(row) > 2)
+        return rows
+
+    def get_next_empty_row(self, sheet_title):
+        if sheet_title not in self.row_counts:
+            hint = self.row_hints.pop(sheet_title, None)
+            if hint is None or not self.check_row_hint(sheet_title, *hint):
+                self.read_rows(sheet_title)
+        return self.row_counts[sheet_title] + 1
+
+    def load_row_counts(self, counts):
+        """Use {title: (row_count, has_total)} saved by an earlier run instead of downloading A:E.
+
+        Each hint is checked against the sheet before it is used, in case rows were edited by hand.
+        """
+        self.row_hints.update(counts)
+
+    def row_state(self):
+        return {title: (row_count, self.total_rows.get(title, False)) for title, row_count in self.row_counts.items()}
+
+    def check_row_hint(self, sheet_title, row_count, has_total):
+        # The last counted row must hold something and the one after it must be empty.
+        result = execute(self.service.spreadsheets().values().get(
+            spreadsheetId=self.spreadsheet_id,
+            range=f"{sheet_title}!A{max(row_count, 1)}:E{row_count + 1}"
+        ), self.limiter)
+        if len(result.get('values', [])) != (1 if row_count else 0):
+            return False
+        self.row_counts[sheet_title] = row_count
+        self.total_rows[sheet_title] = has_total
+        return True
+
+    def create_sheet(self, sheet_title):
+        create_sheet_body = {'requests': [{'addSheet': {'properties': {'title': sheet_title, 'gridProperties': {'rowCount': 100, 'columnCount': 10}}}}]}
+        response = execute(self.service.spreadsheets().batchUpdate(spreadsheetId=self.spreadsheet_id, body=create_sheet_body), self.limiter)
+        print(f"New sheet '{sheet_title}' created.")
+        sheet_id = response['replies'][0]['addSheet']['properties']['sheetId']
+        self.get_sheet_titles()
+        self.sheet_ids[sheet_title] = sheet_id
+        self.grid_rows[sheet_title] = response['replies'][0]['addSheet']['properties']['gridProperties']['rowCount']
+        self.row_counts[sheet_title] = 0
+        self.total_rows[sheet_title] = False
+        return sheet_id
+
+    def queue_items(self, new_items):
+        """Buffer items until the next flush()."""
+        self.pending_items.extend(new_items)
+
+    def flush(self, sheet_title="Sheet1"):
+        """Write every buffered item in one values().batchUpdate and return the items that were appended.
+
+        Duplicates are expected to be filtered out beforehand with a SaleIndex.
+        Rows, E-column formulas and the Total row are planned against the cached row
+        counts, and tabs too small for them are grown first. Once `sheet_title` holds
+        `rows_per_sheet` rows, a Total row is added and the rest go to Sheet_<date>,
+        which is created first if it does not exist yet.
+        """
+        items, self.pending_items = self.pending_items, []
+        if not items:
             print("No new items to append.")
-            return
-        missing_items.reverse()
-        next_row = self.get_next_empty_row(sheet_title)
-        for item in missing_items:
-            formula = f"=D{next_row} - B{next_row} / 5"
-            values = [[None, None, item['name'], item['price'], formula]]
-            body = {'values': values}
-            self.service.spreadsheets().values().update(
-                spreadsheetId=SPREADSHEET_ID,
-                range=f"{sheet_title}!A{next_row}:E{next_row}",
-                valueInputOption='USER_ENTERED',
-                body=body
-            ).execute()
+            return []
+        with metrics.stage('write'):
+            # Read per flush: the daemon and push receiver run for days.
+            rollover_title = f"Sheet_{datetime.now().strftime('%Y-%m-%d')}"
+            data = []
+            try:
+                for item in items:
+                    title = sheet_title
+                    current_row_count = self.get_next_empty_row(sheet_title) - 1
+                    if self.rows_per_sheet and current_row_count >= self.rows_per_sheet:
+                        title = rollover_title
+                        if not self.check_if_total_exists(sheet_title, current_row_count):
+                            data.append(self._plan_total_row(sheet_title, current_row_count))
+                        if self.get_sheet_by_title(title) is None:
+                            self.create_sheet(title)
+                    next_row = self.get_next_empty_row(title)
+                    values = [None, None, item['name'], item['price'], f"=D{next_row} - B{next_row} / 5"]
+                    data.append({'range': f"{title}!A{next_row}:E{next_row}", 'values': [values]})
+                    self.row_counts[title] = next_row
+                    # Where the sale lands, so a cost entered later in column B can be matched back to it.
+                    item['sheet_title'], item['sheet_row'] = title, next_row
+
+                # Sheets rejects the whole batchUpdate if any range lies outside its tab's grid.
+                self._grow_grids()
+                execute(self.service.spreadsheets().values().batchUpdate(
+                    spreadsheetId=self.spreadsheet_id,
+                    body={'valueInputOption': 'USER_ENTERED', 'data': data}
+                ), self.limiter)
+            except Exception:
+                # The cached counters already include the rows we planned; re-read them next time.
+                self.refresh_metadata()
+                raise
+        metrics.add_items('write', len(items))
+        for item in items:
             print(f"Appended: {item['name']} - {item['price']} €")
-            next_row += 1
+        return items
+
+    def _read_rows(self, columns, chunk_rows=READ_CHUNK_ROWS):
+        """Yield (title, row_number, values) for every non-empty row of `columns` across all sheets.
+
+        Every sheet is read `chunk_rows` rows at a time, all sheets in one batchGet per chunk,
+        up to the sheet's grid size.
+        """
+        first_column, last_column = columns.split(':')
+        titles = self.get_sheet_titles()
+        start = 1
+        while titles := [title for title in titles
+                         if max(self.grid_rows.get(title, 0), self.row_counts.get(title, 0)) >= start]:
+            quoted = [title.replace("'", "''") for title in titles]
+            result = execute(self.service.spreadsheets().values().batchGet(
+                spreadsheetId=self.spreadsheet_id,
+                ranges=[f"'{title}'!{first_column}{start}:{last_column}{start + chunk_rows - 1}" for title in quoted],
+                valueRenderOption='UNFORMATTED_VALUE'
+            ), self.limiter)
+            for title, value_range in zip(titles, result.get('valueRanges', [])):
+                for offset, row in enumerate(value_range.get('values', [])):
+                    if row:
+                        yield title, start + offset, row
+            start += chunk_rows
+
+    def read_sales(self, chunk_rows=READ_CHUNK_ROWS):
+        """Yield (name, price) for every sale row across all sheets, skipping Total rows."""
+        for _, _, row in self._read_rows('C:D', chunk_rows):
+            if row[0] not in ("", "Total"):
+                yield row[0], row[1] if len(row) > 1 else None
+
+    def read_costs(self, chunk_rows=READ_CHUNK_ROWS):
+        """Yield (title, row_number, cost, name, price) for every sale row with a cost entered in column B."""
+        for title, row_number, row in self._read_rows('B:D', chunk_rows):
+            row = row + [None] * (3 - len(row))
+            if isinstance(row[0], (int, float)) and row[1] not in (None, "", "Total"):
+                yield title, row_number, row[0], row[1], row[2]
+
+    def _grow_grids(self):
+        """Append rows to every tab whose grid is smaller than the rows planned for it, in one batchUpdate."""
+        self.get_sheet_titles()
+        requests = []
+        for title, row_count in self.row_counts.items():
+            grid_rows = self.grid_rows.get(title)
+            if grid_rows is not None and row_count > grid_rows:
+                requests.append({'appendDimension': {'sheetId': self.sheet_ids[title], 'dimension': 'ROWS',
+                                                     'length': row_count - grid_rows}})
+                self.grid_rows[title] = row_count
+        if requests:
+            execute(self.service.spreadsheets().batchUpdate(
+                spreadsheetId=self.spreadsheet_id, body={'requests': requests}), self.limiter)
+
+    def _plan_total_row(self, sheet_title, current_row_count):
+        total_row = [None, None, "Total", f"=SUM(D1:D{current_row_count})", f"=SUM(E1:E{current_row_count})"]
+        self.row_counts[sheet_title] = current_row_count + 1
+        self.total_rows[sheet_title] = True
+        print("Total row appended. Now creating a new sheet.")
+        return {'range': f"{sheet_title}!A{current_row_count + 1}:E{current_row_count + 1}", 'values': [total_row]}
 
     def handle_totals_and_new_sheet(self, sheet_title, new_items):
-        result = self.service.spreadsheets().values().get(
-            spreadsheetId=SPREADSHEET_ID, range="Sheet1!A:E").execute()
-        
-        current_row_count = len(result.get('values', []))
-        if current_row_count >= 50:
-            if not self.check_if_total_exists(sheet_title, current_row_count):
-                total_row = [[None, None, "Total", f"=SUM(D1:D{current_row_count})", f"=SUM(E1:E{current_row_count})"]]
-                self.service.spreadsheets().values().append(
-                    spreadsheetId=SPREADSHEET_ID,
-                    range=f"Sheet1!A{current_row_count + 1}:E{current_row_count + 1}",
-                    valueInputOption='USER_ENTERED',
-                    body={'values': total_row}
-                ).execute()
-                print("Total row appended. Now creating a new sheet.")
-
-            new_sheet_title = f"Sheet_{CURRENT_DATE}"
-            new_sheet_id = self.get_sheet_by_title(new_sheet_title)
-            if new_sheet_id is None:
-                create_sheet_body = {'requests': [{'addSheet': {'properties': {'title': new_sheet_title, 'gridProperties': {'rowCount': 100, 'columnCount': 10}}}}]}
-                self.service.spreadsheets().batchUpdate(spreadsheetId=SPREADSHEET_ID, body=create_sheet_body).execute()
-                print(f"New sheet '{new_sheet_title}' created.")
-            self.append_new_items_in_decreasing_order(new_sheet_title, new_items)
-        else:
-            self.append_new_items_in_decreasing_order(sheet_title, new_items)
+        self.queue_items(reversed(new_items))
+        return self.flush(sheet_title)
 
 
 ### Main Process:
 
-def main():
-    gmail_manager = GmailManager()
-    sheets_manager = GoogleSheets()
-
-    emails = gmail_manager.fetch_emails()
-    if not emails:
-        print("No emails found.")
+def main(full_resync=False, query=DEFAULT_QUERY, sale_subject=SALE_SUBJECT, reconcile_index=False,
+         parse_workers=PARSE_WORKERS, report_path=RUN_REPORT_FILE, prometheus_path=None, tracing=False,
+         use_email_cache=True, flush_size=FLUSH_SIZE, rollover=True):
+    if tracing:
+        metrics.enable_tracing()
+    found = outcome = None
+    try:
+        with metrics.stage('sync'):
+            gmail_manager = GmailManager(query=query, sale_subject=sale_subject)
+            sheets_manager = GoogleSheets(rows_per_sheet=ROWS_PER_SHEET if rollover else None)
+            state = SyncState()
+            sale_index = SaleIndex()
+            email_cache = EmailCache() if use_email_cache else None
+            sales_store = SalesStore()
+            found = asyncio.run(run_sync(gmail_manager, sheets_manager, state, sale_index, full_resync=full_resync,
+                                         reconcile_index=reconcile_index, parse_workers=parse_workers,
+                                         email_cache=email_cache, flush_size=flush_size,
+                                         sales_store=sales_store))
+        outcome = 'ok'
+    except HttpError as error:
+        # run_sync only moves the checkpoint after a clean run, so the next run retries from here.
+        outcome = 'error'
+        print(f"An error occurred: {error}")
         return
+    finally:
+        print(stats.summary())
+        if report_path:
+            metrics.write_report(report_path, outcome=outcome or 'error', found=found,
+                                 retries=dict(stats.retries), throttled_seconds=round(stats.throttled_seconds, 3))
+        if prometheus_path:
+            metrics.write_prometheus(prometheus_path)
 
-    for email in emails:
-        msg = gmail_manager.service.users().messages().get(userId='me', id=email['id']).execute()
-        subject = gmail_manager.get_message_subject(msg)
-        if subject == "This order is completed":
-            body = gmail_manager.get_message_body(msg)
-            item, price = gmail_manager.extract_item_and_price(body)
-            sheets_manager.handle_totals_and_new_sheet("Sheet1", [{'name': item, 'price': float(price[:-2])}])
+    if not found:
+        print("No emails found.")
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Copy completed Vinted sales from Gmail to Google Sheets.")
+    parser.add_argument('--full-resync', action='store_true',
+                        help="ignore the stored historyId and re-list the whole mailbox")
+    parser.add_argument('--query', default=DEFAULT_QUERY, help="Gmail search query used for full syncs")
+    parser.add_argument('--subject', default=SALE_SUBJECT, help="exact subject of the sale confirmation emails")
+    parser.add_argument('--reconcile-index', action='store_true',
+                        help="import sales that were added to the sheet by hand into the local index")
+    parser.add_argument('--parse-workers', type=int, default=PARSE_WORKERS,
+                        help="worker processes for decoding and parsing emails (0 parses inline)")
+    parser.add_argument('--flush-size', type=int, default=FLUSH_SIZE,
+                        help="write sales to the sheet in flushes of at most this many rows")
+    parser.add_argument('--no-rollover', action='store_true',
+                        help="keep appending to Sheet1 instead of adding Total rows and Sheet_<date> tabs; "
+                             "totals come from the local sales store (python sales_store.py)")
+    parser.add_argument('--no-email-cache', action='store_true',
+                        help="fetch and parse every message again instead of using the local parse cache")
+    parser.add_argument('--report', default=RUN_REPORT_FILE,
+                        help="write a JSON run report with stage timings and API calls here ('' to skip)")
+    parser.add_argument('--prometheus', help="also write the metrics in Prometheus text format to this file")
+    parser.add_argument('--otel', action='store_true',
+                        help="emit OpenTelemetry spans for stages and API calls (needs opentelemetry-api)")
+    args = parser.parse_args()
+    main(full_resync=args.full_resync, query=args.query, sale_subject=args.subject,
+         reconcile_index=args.reconcile_index, parse_workers=args.parse_workers, report_path=args.report,
+         prometheus_path=args.prometheus, tracing=args.otel, use_email_cache=not args.no_email_cache,
+         flush_size=args.flush_size, rollover=not args.no_rollover)
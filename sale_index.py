@@ -0,0 +1,86 @@
+import sqlite3
+import threading
+
+INDEX_FILE = 'sale_index.sqlite3'
+
+
+class SaleIndex:
+    """Local SQLite record of every sale already written to the sheet.
+
+    Sales we append are keyed on their Gmail message ID. Rows imported from the sheet by
+    reconcile() have no message ID; the first sale with the same name and price claims one.
+    Lookups go to SQLite rather than an in-memory copy, so memory stays flat however many
+    sales there are. The index also remembers how many rows each sheet tab holds.
+    The connection is shared by the pipeline's worker threads behind a lock.
+    """
+
+    def __init__(self, path=INDEX_FILE):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS sales (message_id TEXT UNIQUE, name TEXT NOT NULL, price REAL)")
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS sales_unclaimed ON sales (name, price) WHERE message_id IS NULL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS sheet_rows (title TEXT PRIMARY KEY, row_count INTEGER NOT NULL, "
+                "has_total INTEGER NOT NULL)")
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM sales").fetchone()[0]
+
+    def is_recorded(self, item):
+        """Return True if `item` is already in the sheet, claiming a matching imported row for it."""
+        with self.lock:
+            if self.connection.execute("SELECT 1 FROM sales WHERE message_id = ?", (item['message_id'],)).fetchone():
+                return True
+            with self.connection:
+                return self._claim(item)
+
+    def _claim(self, item):
+        cursor = self.connection.execute(
+            "UPDATE sales SET message_id = ? WHERE rowid = (SELECT rowid FROM sales "
+            "WHERE message_id IS NULL AND name = ? AND price = ? LIMIT 1)",
+            (item['message_id'], item['name'], item['price']))
+        return cursor.rowcount > 0
+
+    def add(self, items):
+        with self.lock, self.connection:
+            for item in items:
+                if not self._claim(item):
+                    self.connection.execute("INSERT OR IGNORE INTO sales (message_id, name, price) VALUES (?, ?, ?)",
+                                            (item['message_id'], item['name'], item['price']))
+
+    def reconcile(self, sheet_sales):
+        """Import (name, price) rows from the sheet that the index does not know about yet.
+
+        `sheet_sales` may be any iterable; it is streamed into a temporary table.
+        """
+        with self.lock, self.connection:
+            self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS sheet_sales (name TEXT, price REAL)")
+            self.connection.execute("DELETE FROM sheet_sales")
+            self.connection.executemany("INSERT INTO sheet_sales (name, price) VALUES (?, ?)", sheet_sales)
+            # The n-th copy of a (name, price) pair in the sheet is missing if the index has fewer than n.
+            cursor = self.connection.execute(
+                "INSERT INTO sales (message_id, name, price) SELECT NULL, name, price FROM "
+                "(SELECT name, price, ROW_NUMBER() OVER (PARTITION BY name, price) AS copy FROM sheet_sales) AS sheet "
+                "WHERE copy > (SELECT COUNT(*) FROM sales WHERE sales.name = sheet.name AND sales.price IS sheet.price)")
+            imported = cursor.rowcount
+            self.connection.execute("DROP TABLE sheet_sales")
+        print(f"Imported {imported} sales from the sheet into the local index.")
+
+    def sheet_rows(self):
+        """Return {title: (row_count, has_total)} as of the last flush."""
+        with self.lock:
+            return {title: (row_count, bool(has_total)) for title, row_count, has_total
+                    in self.connection.execute("SELECT title, row_count, has_total FROM sheet_rows")}
+
+    def save_sheet_rows(self, counts):
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO sheet_rows (title, row_count, has_total) VALUES (?, ?, ?)",
+                ((title, row_count, has_total) for title, (row_count, has_total) in counts.items()))
+
+    def close(self):
+        self.connection.close()
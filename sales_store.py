@@ -0,0 +1,157 @@
+import argparse
+import json
+import sqlite3
+import threading
+
+STORE_FILE = 'sales.sqlite3'
+# Profit as the sheet's E column computes it: =D - B/5, with a blank cost counting as 0.
+PROFIT = "price - COALESCE(cost, 0) / 5"
+
+
+class SalesStore:
+    """Local SQLite copy of every sale, for reports that would otherwise read every sheet tab back.
+
+    The sheet is a view of this store: a sale is `synced` once it has been written there.
+    Sales that were already in the sheet when first seen are stored as synced.
+    """
+
+    def __init__(self, path=STORE_FILE):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS sales (message_id TEXT PRIMARY KEY, name TEXT NOT NULL, "
+                "price REAL NOT NULL, cost REAL, sale_date TEXT, currency TEXT, synced INTEGER NOT NULL DEFAULT 0)")
+            # Covering indexes: the aggregates below read only the index, never the table.
+            self.connection.execute("CREATE INDEX IF NOT EXISTS sales_date ON sales (sale_date, price, cost)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS sales_name ON sales (name, price, cost)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS sales_unsynced ON sales (sale_date) WHERE synced = 0")
+            columns = {row[1] for row in self.connection.execute("PRAGMA table_info(sales)")}
+            # Where the sale was written in the sheet; stores created before this was kept get it on import_costs().
+            if 'sheet_title' not in columns:
+                self.connection.execute("ALTER TABLE sales ADD COLUMN sheet_title TEXT")
+                self.connection.execute("ALTER TABLE sales ADD COLUMN sheet_row INTEGER")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS sales_sheet_row ON sales (sheet_title, sheet_row) "
+                                    "WHERE sheet_title IS NOT NULL")
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM sales").fetchone()[0]
+
+    def add(self, sales, synced=False):
+        """Store new sales; ones we already have keep their sync state."""
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO sales (message_id, name, price, sale_date, currency, synced) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                ((sale['message_id'], sale['name'], sale['price'], sale.get('date'), sale.get('currency'),
+                  int(synced)) for sale in sales))
+
+    def mark_synced(self, sales):
+        """Mark sales as written to the sheet, remembering the row for the ones appended by this run."""
+        sales = list(sales)
+        located = [(sale['sheet_title'], sale['sheet_row'], sale['message_id'])
+                   for sale in sales if sale.get('sheet_row')]
+        with self.lock, self.connection:
+            # A row can be reused after rows were deleted by hand; only its latest sale keeps it.
+            self.connection.executemany(
+                "UPDATE sales SET sheet_title = NULL, sheet_row = NULL "
+                "WHERE sheet_title = ? AND sheet_row = ? AND message_id != ?", located)
+            self.connection.executemany(
+                "UPDATE sales SET synced = 1, sheet_title = COALESCE(?, sheet_title), "
+                "sheet_row = COALESCE(?, sheet_row) WHERE message_id = ?",
+                ((sale.get('sheet_title'), sale.get('sheet_row'), sale['message_id']) for sale in sales))
+
+    def unsynced(self):
+        """Sales not written to the sheet yet, oldest first."""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT message_id, name, price, sale_date, currency FROM sales WHERE synced = 0 "
+                "ORDER BY sale_date").fetchall()
+        return [{'message_id': message_id, 'name': name, 'price': price, 'date': date, 'currency': currency}
+                for message_id, name, price, date, currency in rows]
+
+    def import_costs(self, sheet_costs):
+        """Store the costs entered in the sheet's B column; returns how many sales got one.
+
+        `sheet_costs` yields (title, row, cost, name, price), as GoogleSheets.read_costs() does.
+        A row no sale was written to by us is claimed by the oldest sale with the same name and
+        price that has no row yet, e.g. one synced before rows were remembered.
+        """
+        # Read the sheet before taking the lock.
+        sheet_costs = list(sheet_costs)
+        updated = 0
+        with self.lock, self.connection:
+            for title, row, cost, name, price in sheet_costs:
+                cursor = self.connection.execute(
+                    "UPDATE sales SET cost = ? WHERE sheet_title = ? AND sheet_row = ?", (cost, title, row))
+                if not cursor.rowcount:
+                    cursor = self.connection.execute(
+                        "UPDATE sales SET cost = ?, sheet_title = ?, sheet_row = ? WHERE rowid = (SELECT rowid "
+                        "FROM sales WHERE sheet_title IS NULL AND name = ? AND price = ? ORDER BY sale_date LIMIT 1)",
+                        (cost, title, row, name, price))
+                updated += cursor.rowcount
+        return updated
+
+    def _query(self, sql, parameters=()):
+        with self.lock:
+            cursor = self.connection.execute(sql, parameters)
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor]
+
+    def _where(self, start, end):
+        # Dates are ISO strings, so range filters use the sale_date index.
+        clauses, parameters = [], []
+        if start:
+            clauses.append("sale_date >= ?")
+            parameters.append(start)
+        if end:
+            clauses.append("sale_date < ?")
+            parameters.append(end)
+        return (f"WHERE {' AND '.join(clauses)}" if clauses else ""), parameters
+
+    def totals(self, start=None, end=None):
+        where, parameters = self._where(start, end)
+        return self._query(f"SELECT COUNT(*) AS sales, ROUND(COALESCE(SUM(price), 0), 2) AS revenue, "
+                           f"ROUND(COALESCE(SUM({PROFIT}), 0), 2) AS profit FROM sales {where}", parameters)[0]
+
+    def by_month(self, start=None, end=None):
+        where, parameters = self._where(start, end)
+        return self._query(f"SELECT substr(sale_date, 1, 7) AS month, COUNT(*) AS sales, "
+                           f"ROUND(SUM(price), 2) AS revenue, ROUND(SUM({PROFIT}), 2) AS profit "
+                           f"FROM sales {where} GROUP BY month ORDER BY month", parameters)
+
+    def by_item(self, start=None, end=None, limit=20):
+        where, parameters = self._where(start, end)
+        return self._query(f"SELECT name, COUNT(*) AS sales, ROUND(SUM(price), 2) AS revenue, "
+                           f"ROUND(AVG(price), 2) AS average_price, ROUND(SUM({PROFIT}), 2) AS profit "
+                           f"FROM sales {where} GROUP BY name ORDER BY revenue DESC LIMIT ?", [*parameters, limit])
+
+    def close(self):
+        self.connection.close()
+
+
+def print_report(store, by=None, start=None, end=None, as_json=False):
+    rows = {'month': store.by_month, 'item': store.by_item}[by](start, end) if by else [store.totals(start, end)]
+    if as_json:
+        print(json.dumps(rows, indent=2))
+        return
+    if not rows:
+        print("No sales.")
+        return
+    columns = list(rows[0])
+    widths = [max(len(column), *(len(str(row[column])) for row in rows)) for column in columns]
+    print('  '.join(column.ljust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print('  '.join(str(row[column]).ljust(width) for column, width in zip(columns, widths)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report on the sales in the local sales store.")
+    parser.add_argument('--by', choices=['month', 'item'], help="group the report (default: totals only)")
+    parser.add_argument('--from', dest='start', help="first sale date to include, YYYY-MM-DD")
+    parser.add_argument('--to', dest='end', help="first sale date to exclude, YYYY-MM-DD")
+    parser.add_argument('--json', action='store_true', help="print JSON instead of a table")
+    parser.add_argument('--store', default=STORE_FILE)
+    args = parser.parse_args()
+    print_report(SalesStore(args.store), args.by, args.start, args.end, args.json)
@@ -0,0 +1,23 @@
+import json
+import os
+from datetime import datetime
+
+STATE_FILE = 'sync_state.json'
+
+
+class SyncState:
+    """Checkpoint of the last Gmail historyId we synced, kept in a local JSON file."""
+
+    def __init__(self, path=STATE_FILE):
+        self.path = path
+        self.history_id = None
+        if os.path.exists(path):
+            with open(path) as state_file:
+                self.history_id = json.load(state_file).get('historyId')
+
+    def save(self, history_id):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as state_file:
+            json.dump({'historyId': history_id, 'updated': datetime.now().isoformat()}, state_file)
+        os.replace(tmp_path, self.path)
+        self.history_id = history_id
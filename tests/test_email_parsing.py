@@ -0,0 +1,28 @@
+import os
+
+import pytest
+
+import email_parsing
+
+pytest.importorskip('bs4')
+
+EMAILS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'emails')
+
+
+def load(name):
+    with open(os.path.join(EMAILS, name), encoding='utf-8') as saved_email:
+        return saved_email.read()
+
+
+@pytest.mark.parametrize('name', sorted(os.listdir(EMAILS)))
+def test_fast_paths_match_beautifulsoup(name):
+    html_body = load(name)
+    expected = email_parsing._extract_soup(html_body)
+    assert email_parsing._extract_prescan(html_body) in (None, expected)
+    if email_parsing.lxml is not None:
+        assert email_parsing._extract_lxml(html_body) == expected
+    assert email_parsing.extract_item_and_price(html_body) == expected
+
+
+def test_usual_template_takes_the_prescan():
+    assert email_parsing._extract_prescan(load('template.html')) == ('Nike Air Max', '45.00 €')
@@ -0,0 +1,13 @@
+import pytest
+
+from rate_limit import TokenBucket, fair_share
+
+
+def test_a_batch_larger_than_the_bucket_is_charged_in_full():
+    # Shared by 100 accounts, each bucket refills and holds 200 units a second.
+    units_per_second = fair_share(100)[0]
+    bucket = TokenBucket(units_per_second)
+    # 100 messages.get calls cost 500 units, more than the bucket holds.
+    assert bucket.reserve(500) == pytest.approx(1.5, abs=0.01)
+    # The next caller also waits for the part of the batch the bucket could not cover.
+    assert bucket.reserve(5) == pytest.approx(1.525, abs=0.01)
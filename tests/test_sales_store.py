@@ -0,0 +1,56 @@
+import asyncio
+
+from async_pipeline import run_sync
+from fake_google import FakeBackend, FakeGmail, FakeProvider, FakeSheets
+from refactored_process import GmailManager, GoogleSheets
+from sale_index import SaleIndex
+from sales_store import SalesStore
+from sync_state import SyncState
+
+
+def sync(tmp_path, gmail, sheets, store):
+    provider = FakeProvider(gmail, sheets)
+    asyncio.run(run_sync(GmailManager(credentials_provider=provider), GoogleSheets(credentials_provider=provider),
+                         SyncState(str(tmp_path / 'state.json')), SaleIndex(str(tmp_path / 'index.sqlite3')),
+                         sales_store=store))
+    return GoogleSheets(credentials_provider=provider)
+
+
+def test_costs_entered_in_the_sheet_reach_the_report(tmp_path):
+    backend = FakeBackend()
+    gmail = FakeGmail(backend, messages=0)
+    sheets = FakeSheets(backend)
+    for item, price in [("Nike Air Max", 40.0), ("Zara wool coat", 25.0), ("Adidas hoodie", 15.0)]:
+        gmail.add_message("This order is completed", item, price)
+    store = SalesStore(str(tmp_path / 'sales.sqlite3'))
+    sheets_manager = sync(tmp_path, gmail, sheets, store)
+
+    rows = {row[2]: number for number, row in enumerate(sheets.tabs['Sheet1'], start=1)}
+    sheets.tabs['Sheet1'][rows["Nike Air Max"] - 1][1] = 20.0
+    sheets.tabs['Sheet1'][rows["Zara wool coat"] - 1][1] = 5
+
+    assert store.import_costs(sheets_manager.read_costs()) == 2
+    totals = store.totals()
+    assert totals == {'sales': 3, 'revenue': 80.0, 'profit': 75.0}
+    by_item = {row['name']: row['profit'] for row in store.by_item()}
+    assert by_item == {"Nike Air Max": 36.0, "Zara wool coat": 24.0, "Adidas hoodie": 15.0}
+
+
+def test_sales_synced_before_rows_were_kept_are_matched_by_name_and_price(tmp_path):
+    backend = FakeBackend()
+    sheets = FakeSheets(backend)
+    provider = FakeProvider(FakeGmail(backend, messages=0), sheets)
+    sheets_manager = GoogleSheets(credentials_provider=provider)
+    sheets_manager.queue_items([{'message_id': 'a', 'name': "Levi's 501 jeans", 'price': 30.0},
+                                {'message_id': 'b', 'name': "Levi's 501 jeans", 'price': 30.0}])
+    sheets_manager.flush()
+    sheets.tabs['Sheet1'][0][1] = 10.0
+    sheets.tabs['Sheet1'][1][1] = 15.0
+    store = SalesStore(str(tmp_path / 'sales.sqlite3'))
+    store.add([{'message_id': 'a', 'name': "Levi's 501 jeans", 'price': 30.0, 'date': '2024-01-01'},
+               {'message_id': 'b', 'name': "Levi's 501 jeans", 'price': 30.0, 'date': '2024-01-02'}], synced=True)
+
+    assert store.import_costs(sheets_manager.read_costs()) == 2
+    # A second import finds both rows by their position and does not claim anything new.
+    assert store.import_costs(sheets_manager.read_costs()) == 2
+    assert store.totals() == {'sales': 2, 'revenue': 60.0, 'profit': 55.0}
@@ -0,0 +1,126 @@
+import asyncio
+
+import pytest
+import requests
+
+import api_calls
+from async_pipeline import run_sync
+from fake_google import FakeBackend, FakeGmail, FakeProvider, FakeSheets
+from push_receiver import PushReceiver
+from refactored_process import GmailManager, GoogleSheets
+from sale_index import SaleIndex
+from sales_store import SalesStore
+from sync_state import SyncState
+
+
+class FailingBackend(FakeBackend):
+    """Fake backend whose messages.get calls fail with a connection error from the `fail_from`-th on."""
+
+    def __init__(self):
+        super().__init__()
+        self.fail_from = None
+
+    def call(self, method_id, handler, batched=False):
+        if method_id == 'gmail.users.messages.get' and self.fail_from is not None:
+            if self.calls[method_id] + 1 >= self.fail_from:
+                raise requests.exceptions.ConnectionError("connection reset")
+        return super().call(method_id, handler, batched)
+
+
+@pytest.fixture
+def account(tmp_path, monkeypatch):
+    monkeypatch.setattr(api_calls, 'BASE_DELAY', 0.0)
+    backend = FailingBackend()
+    gmail = FakeGmail(backend, messages=0)
+    sheets = FakeSheets(backend)
+    provider = FakeProvider(gmail, sheets)
+    return {
+        'backend': backend, 'gmail': gmail, 'sheets': sheets,
+        'gmail_manager': GmailManager(credentials_provider=provider, batch_size=10, max_workers=1),
+        'sheets_manager': GoogleSheets(credentials_provider=provider),
+        'state': SyncState(str(tmp_path / 'state.json')),
+        'sale_index': SaleIndex(str(tmp_path / 'index.sqlite3')),
+        'sales_store': SalesStore(str(tmp_path / 'sales.sqlite3')),
+    }
+
+
+def sync(account, **options):
+    return asyncio.run(run_sync(account['gmail_manager'], account['sheets_manager'], account['state'],
+                                account['sale_index'], sales_store=account['sales_store'], **options))
+
+
+def sale_rows(sheets, title='Sheet1'):
+    return [row[2] for row in sheets.tabs[title] if len(row) > 2 and row[2] != "Total"]
+
+
+def add_sales(gmail, prefix, count):
+    for number in range(count):
+        gmail.add_message("This order is completed", f"{prefix} {number}", 10.0 + number)
+
+
+def test_incremental_sync_writes_only_new_sales(account):
+    add_sales(account['gmail'], "old", 5)
+    assert sync(account)
+    add_sales(account['gmail'], "new", 3)
+    account['gmail'].add_message("Your item has been shipped")
+    calls = account['backend'].calls['gmail.users.messages.get']
+    assert sync(account)
+    # A full sync lists the mailbox newest first; history returns the new messages oldest first.
+    assert sale_rows(account['sheets']) == [f"old {n}" for n in reversed(range(5))] + [f"new {n}" for n in range(3)]
+    # Headers for the 4 new messages, then full payloads for the 3 sales.
+    assert account['backend'].calls['gmail.users.messages.get'] - calls == 7
+
+
+def test_incremental_sync_finds_archived_sales(account):
+    add_sales(account['gmail'], "old", 1)
+    sync(account)
+    account['gmail'].add_message("This order is completed", "archived", 20.0, labels=())
+    account['gmail'].add_message("This order is completed", "not a sale", 5.0, sender="someone@example.com")
+    assert sync(account)
+    assert sale_rows(account['sheets']) == ["old 0", "archived"]
+
+
+def test_failed_cycle_does_not_write_its_queued_sales_twice(account):
+    add_sales(account['gmail'], "first", 1)
+    sync(account)
+    add_sales(account['gmail'], "sale", 40)
+    account['backend'].fail_from = account['backend'].calls['gmail.users.messages.get'] + 65
+    with pytest.raises(requests.exceptions.ConnectionError):
+        sync(account)
+    assert len(sale_rows(account['sheets'])) == 1
+    assert account['sheets_manager'].pending_items == []
+
+    # The next cycle reuses the same managers, as the daemon does.
+    account['backend'].fail_from = None
+    account['sheets_manager'].refresh_metadata()
+    sync(account)
+    assert sale_rows(account['sheets']) == ["first 0"] + [f"sale {n}" for n in range(40)]
+    assert account['sheets_manager'].pending_items == []
+
+
+def test_rows_flushed_before_a_failure_are_kept_once(account):
+    add_sales(account['gmail'], "first", 1)
+    sync(account)
+    add_sales(account['gmail'], "sale", 40)
+    account['backend'].fail_from = account['backend'].calls['gmail.users.messages.get'] + 65
+    with pytest.raises(requests.exceptions.ConnectionError):
+        sync(account, flush_size=10)
+    flushed = sale_rows(account['sheets'])
+    assert len(flushed) > 1
+
+    account['backend'].fail_from = None
+    account['sheets_manager'].refresh_metadata()
+    sync(account, flush_size=10)
+    assert sale_rows(account['sheets']) == flushed + [f"sale {n}" for n in range(len(flushed) - 1, 40)]
+    assert not account['sales_store'].unsynced()
+
+
+def test_push_receiver_keeps_rows_added_by_hand(account):
+    receiver = PushReceiver(account['gmail_manager'], account['sheets_manager'], account['state'],
+                            account['sale_index'], 'projects/test/topics/gmail', sales_store=account['sales_store'])
+    add_sales(account['gmail'], "first", 1)
+    receiver.sync()
+    account['sheets'].tabs['Sheet1'].append(['', '', "by hand", '12.0', ''])
+    add_sales(account['gmail'], "second", 1)
+    receiver.sync()
+    assert sale_rows(account['sheets']) == ["first 0", "by hand", "second 0"]
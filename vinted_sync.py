@@ -0,0 +1,139 @@
+"""vinted-sync: one entry point for syncing, backfilling, reporting on and following up on sales.
+
+Each subcommand imports what it needs when it runs, so `--help` and `report` never load
+the Google client libraries, and a sync with no new mail stops after one raw API call.
+"""
+import argparse
+import json
+from urllib.parse import urlencode
+
+from sales_store import STORE_FILE
+from sync_state import SyncState
+
+HISTORY_URL = 'https://gmail.googleapis.com/gmail/v1/users/me/history'
+
+
+def has_new_mail(state):
+    """Return False if no message was added since the stored historyId, checkpointing the newer historyId.
+
+    Uses one history.list call on the shared transport, without building a Gmail service.
+    Returns True when a full sync has to decide, including when the check itself fails.
+    """
+    from google_clients import default_provider
+    query = urlencode({'startHistoryId': state.history_id, 'historyTypes': 'messageAdded', 'maxResults': 1})
+    try:
+        response, content = default_provider().transport().request(f"{HISTORY_URL}?{query}")
+    except OSError:
+        return True
+    if response.status != 200:
+        # 404 means the historyId has expired; the full sync falls back to re-listing the mailbox.
+        return True
+    page = json.loads(content)
+    if page.get('history') or page.get('nextPageToken'):
+        return True
+    state.save(page['historyId'])
+    return False
+
+
+def sync(args):
+    options = {name: value for name, value in vars(args).items() if name not in ('command', 'handler')}
+    if not (options.get('full_resync') or options.get('reconcile_index')):
+        state = SyncState()
+        if state.history_id:
+            from sales_store import SalesStore
+            store = SalesStore()
+            # Sales left over from a failed flush still have to be written, new mail or not.
+            pending = store.unsynced()
+            store.close()
+            if not pending and not has_new_mail(state):
+                print("No new emails.")
+                return
+    from refactored_process import main
+    main(**options)
+
+
+def backfill(args):
+    args.full_resync = True
+    sync(args)
+
+
+def report(args):
+    from sales_store import SalesStore, print_report
+    print_report(SalesStore(args.store), args.by, args.start, args.end, args.json)
+
+
+def costs(args):
+    from refactored_process import GoogleSheets
+    from sales_store import SalesStore
+    store = SalesStore(args.store)
+    print(f"Imported costs for {store.import_costs(GoogleSheets().read_costs())} sales.")
+    store.close()
+
+
+def draft(args):
+    from draft import draft_from_args
+    draft_from_args(args)
+
+
+def add_sync_arguments(parser):
+    # Options left out are not passed on, so refactored_process.main's defaults apply.
+    parser.argument_default = argparse.SUPPRESS
+    parser.add_argument('--query', help="Gmail search query used for full syncs")
+    parser.add_argument('--subject', dest='sale_subject', help="exact subject of the sale confirmation emails")
+    parser.add_argument('--reconcile-index', action='store_true',
+                        help="import sales that were added to the sheet by hand into the local index")
+    parser.add_argument('--parse-workers', type=int,
+                        help="worker processes for decoding and parsing emails (0 parses inline)")
+    parser.add_argument('--flush-size', type=int, help="write sales to the sheet in flushes of at most this many rows")
+    parser.add_argument('--no-rollover', dest='rollover', action='store_false',
+                        help="keep appending to Sheet1 instead of adding Total rows and Sheet_<date> tabs")
+    parser.add_argument('--no-email-cache', dest='use_email_cache', action='store_false',
+                        help="fetch and parse every message again instead of using the local parse cache")
+    parser.add_argument('--report', dest='report_path',
+                        help="write a JSON run report with stage timings and API calls here ('' to skip)")
+    parser.add_argument('--prometheus', dest='prometheus_path',
+                        help="also write the metrics in Prometheus text format to this file")
+    parser.add_argument('--otel', dest='tracing', action='store_true',
+                        help="emit OpenTelemetry spans for stages and API calls (needs opentelemetry-api)")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='vinted-sync',
+                                     description="Copy completed Vinted sales from Gmail to Google Sheets.")
+    subcommands = parser.add_subparsers(dest='command', required=True)
+
+    sync_parser = subcommands.add_parser('sync', help="sync the sales that arrived since the last run")
+    add_sync_arguments(sync_parser)
+    sync_parser.add_argument('--full-resync', action='store_true',
+                             help="ignore the stored historyId and re-list the whole mailbox")
+    sync_parser.set_defaults(handler=sync)
+
+    backfill_parser = subcommands.add_parser('backfill', help="re-list the whole mailbox and add any missing sales")
+    add_sync_arguments(backfill_parser)
+    backfill_parser.set_defaults(handler=backfill)
+
+    report_parser = subcommands.add_parser('report', help="report on the sales in the local sales store")
+    report_parser.add_argument('--by', choices=['month', 'item'], help="group the report (default: totals only)")
+    report_parser.add_argument('--from', dest='start', help="first sale date to include, YYYY-MM-DD")
+    report_parser.add_argument('--to', dest='end', help="first sale date to exclude, YYYY-MM-DD")
+    report_parser.add_argument('--json', action='store_true', help="print JSON instead of a table")
+    report_parser.add_argument('--store', default=STORE_FILE)
+    report_parser.set_defaults(handler=report)
+
+    costs_parser = subcommands.add_parser('costs', help="copy the costs entered in the sheet's B column "
+                                                        "into the local sales store, for report's profit")
+    costs_parser.add_argument('--store', default=STORE_FILE)
+    costs_parser.set_defaults(handler=costs)
+
+    draft_parser = subcommands.add_parser('draft', help="create a Gmail draft for each recipient from a template")
+    draft_parser.add_argument('recipients', help="CSV (with a 'to' column) or JSON file of recipients and their fields")
+    draft_parser.add_argument('--subject', required=True, help="subject template, e.g. 'Thanks for buying {name}!'")
+    draft_parser.add_argument('--body', required=True, help="file holding the body template")
+    draft_parser.add_argument('--from', dest='sender', help="From address (default: the authorized account)")
+    draft_parser.set_defaults(handler=draft)
+    return parser
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+    args.handler(args)